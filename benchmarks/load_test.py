@@ -0,0 +1,254 @@
+"""Load test for POST /q.
+
+By default starts `hypercorn stream_api:app` in a subprocess with the fake LLM, fake
+embeddings and fake vector store (see llmodels/fake.py), so it runs offline and measures
+only our serving path. Point --url at a running server to test a real deployment.
+
+Reports time-to-first-frame, time-to-first-token, tokens/sec per stream, total latency
+percentiles and error rates. --max-p99-ms / --max-error-rate make it exit non-zero, for
+CI-style regression runs.
+
+Usage:
+    python -m benchmarks.load_test --concurrency 32 --requests 500
+    python -m benchmarks.load_test --rate 20 --duration 30          # open loop, Poisson arrivals
+    python -m benchmarks.load_test --url http://localhost:8000 --concurrency 4 --requests 20
+    FAKE_LLM_STALL_RATE=0.1 python -m benchmarks.load_test --hedge    # hedged router over two fakes
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+import numpy as np
+
+QUESTIONS = [
+    "How much does it cost to study a Master's program in Sweden?",
+    "What are the conditions for a permanent residence permit in Sweden?",
+    "How do I get a personnummer as an international student?",
+    "When is the application deadline for the autumn semester?",
+    "Can I work in Sweden while studying?",
+    "How do I apply for a scholarship at a Swedish university?",
+    "Do I have to pay tax on my salary as a student in Sweden?",
+    "How long does it take Migrationsverket to process a residence permit?",
+]
+
+FAKE_ENV = {
+    'LLM_BACKEND': 'fake',
+    'EMBED_MODEL_ID': 'fake',
+    'VECTOR_BACKEND': 'fake',
+}
+
+
+class Result:
+    def __init__(self):
+        self.status = None
+        self.error = None
+        self.first_frame = None     # seconds from request start
+        self.first_token = None
+        self.total = None
+        self.tokens = 0
+        self.frames = 0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def start_server(port: int, env: dict) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'hypercorn', 'stream_api:app', '--bind', f'127.0.0.1:{port}'],
+        env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    async with aiohttp.ClientSession() as session:
+        for _ in range(600):
+            if server.poll() is not None:
+                raise RuntimeError(f"Server exited with code {server.returncode}")
+            try:
+                async with session.get(f'http://127.0.0.1:{port}/readyz') as response:
+                    if response.status == 200:
+                        return server
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Server did not become ready within 60s")
+
+
+def parse_frame(line: bytes):
+    line = line.strip()
+    if line.startswith(b'data:'):
+        line = line[5:].strip()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+async def one_request(session: aiohttp.ClientSession, url: str, question: str, sse: bool) -> Result:
+    result = Result()
+    headers = {'Accept': 'text/event-stream'} if sse else {}
+    start = time.perf_counter()
+    try:
+        async with session.post(f'{url}/q', json={'messages': [{'content': question}]}, headers=headers) as response:
+            result.status = response.status
+            if response.status != 200:
+                await response.read()
+                result.error = f'HTTP {response.status}'
+                return result
+            async for line in response.content:
+                frame = parse_frame(line)
+                if frame is None:
+                    continue
+                now = time.perf_counter() - start
+                result.frames += 1
+                if result.first_frame is None:
+                    result.first_frame = now
+                content = frame['choices'][0].get('delta', {}).get('content')
+                if content:
+                    if result.first_token is None:
+                        result.first_token = now
+                    # the fake LLM streams one word per token
+                    result.tokens += len(content.split())
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        result.error = type(e).__name__
+    finally:
+        result.total = time.perf_counter() - start
+    return result
+
+
+def question_for(i: int, cache_hit_ratio: float) -> str:
+    question = random.choice(QUESTIONS)
+    if random.random() < cache_hit_ratio:
+        return question
+    # A suffix of random ids pulls the query far enough from earlier ones to miss the
+    # semantic cache, so the request exercises the full retrieval + generation path. It also
+    # dilutes the query embedding; the fake store has no score threshold, so chunks are
+    # still retrieved (a real store would drop most of them at its 0.3 threshold).
+    nonce = ' '.join(f'{random.getrandbits(32):08x}' for _ in range(8))
+    return f"{question} [{i} {nonce}]"
+
+
+async def closed_loop(url, concurrency, requests, sse, cache_hit_ratio, timeout):
+    results = []
+    counter = iter(range(requests))
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def user():
+            for i in counter:
+                results.append(await one_request(session, url, question_for(i, cache_hit_ratio), sse))
+        await asyncio.gather(*[user() for _ in range(concurrency)])
+    return results
+
+
+async def open_loop(url, rate, duration, sse, cache_hit_ratio, timeout):
+    tasks = []
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        end = time.perf_counter() + duration
+        i = 0
+        while time.perf_counter() < end:
+            tasks.append(asyncio.create_task(one_request(session, url, question_for(i, cache_hit_ratio), sse)))
+            i += 1
+            await asyncio.sleep(random.expovariate(rate))
+        return await asyncio.gather(*tasks)
+
+
+def percentiles(values, ps=(50, 90, 99)) -> dict:
+    if not values:
+        return {f'p{p}': None for p in ps}
+    return {f'p{p}': round(float(np.percentile(values, p)) * 1000, 1) for p in ps}
+
+
+def summarize(results, wall_seconds) -> dict:
+    ok = [r for r in results if r.error is None]
+    errors = {}
+    for r in results:
+        if r.error is not None:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    stream_rates = [r.tokens / (r.total - r.first_token) for r in ok
+                    if r.first_token is not None and r.total > r.first_token]
+    return {
+        'requests': len(results),
+        'ok': len(ok),
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else 0.0,
+        'errors': errors,
+        'wall_seconds': round(wall_seconds, 2),
+        'throughput_rps': round(len(ok) / wall_seconds, 2) if wall_seconds else None,
+        'time_to_first_frame_ms': percentiles([r.first_frame for r in ok if r.first_frame is not None]),
+        'time_to_first_token_ms': percentiles([r.first_token for r in ok if r.first_token is not None]),
+        'total_latency_ms': percentiles([r.total for r in ok]),
+        'tokens_per_sec_per_stream': round(float(np.mean(stream_rates)), 1) if stream_rates else None,
+        'tokens_per_sec_total': round(sum(r.tokens for r in ok) / wall_seconds, 1) if wall_seconds else None,
+        'frames_per_request': round(float(np.mean([r.frames for r in ok])), 1) if ok else None,
+    }
+
+
+async def main_async(args) -> dict:
+    server = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        env = dict(FAKE_ENV)
+        if args.hedge:
+            env.update(LLM_BACKEND='hedged', HEDGE_PRIMARY='fake', HEDGE_SECONDARY='fake')
+        server = await start_server(port, env)
+        url = f'http://127.0.0.1:{port}'
+    try:
+        start = time.perf_counter()
+        if args.rate:
+            results = await open_loop(url, args.rate, args.duration, args.sse, args.cache_hit_ratio, args.timeout)
+        else:
+            results = await closed_loop(url, args.concurrency, args.requests, args.sse, args.cache_hit_ratio,
+                                        args.timeout)
+        return summarize(results, time.perf_counter() - start)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='Base URL of a running server; default starts a fake-backend server')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent clients (closed loop)')
+    parser.add_argument('--requests', type=int, default=200, help='Total requests (closed loop)')
+    parser.add_argument('--rate', type=float, default=0, help='Arrival rate in req/s; enables open loop')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of arrivals (open loop)')
+    parser.add_argument('--cache-hit-ratio', type=float, default=0.0, help='Fraction of repeated questions')
+    parser.add_argument('--hedge', action='store_true',
+                        help='Serve through the hedged router with fake primary and secondary backends')
+    parser.add_argument('--sse', action='store_true', help='Request SSE framing instead of NDJSON')
+    parser.add_argument('--timeout', type=float, default=120, help='Per-request timeout in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON only')
+    parser.add_argument('--max-p99-ms', type=float, help='Fail if total latency p99 exceeds this')
+    parser.add_argument('--max-error-rate', type=float, help='Fail if the error rate exceeds this')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    summary = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        for key, value in summary.items():
+            print(f'{key:<28} {value}')
+
+    failed = False
+    if args.max_p99_ms is not None and (summary['total_latency_ms']['p99'] or 0) > args.max_p99_ms:
+        print(f"FAIL: total latency p99 above {args.max_p99_ms} ms", file=sys.stderr)
+        failed = True
+    if args.max_error_rate is not None and summary['error_rate'] > args.max_error_rate:
+        print(f"FAIL: error rate above {args.max_error_rate}", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Micro-benchmark: LangChain's maximal_marginal_relevance vs the NumPy mmr_select used by MMRRetriever.
+
+Usage: python -m benchmarks.mmr_bench
+"""
+import timeit
+
+import numpy as np
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+from llmodels.mmr import mmr_select, normalize
+
+DIMENSION = 384     # all-MiniLM-L6-v2
+K = 4
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'fetch_k':>8} {'langchain ms':>14} {'numpy ms':>10} {'speedup':>8}  same selection")
+    for fetch_k in (20, 50, 200, 1000):
+        query = normalize(rng.normal(size=DIMENSION).astype(np.float32))
+        candidates = normalize(rng.normal(size=(fetch_k, DIMENSION)).astype(np.float32))
+        # LangChain's path receives the Pinecone 'values' as a list of lists
+        candidate_list = candidates.tolist()
+
+        baseline = maximal_marginal_relevance(query, candidate_list, lambda_mult=0.5, k=K)
+        ours = mmr_select(query, candidates, k=K, lambda_mult=0.5)
+
+        number = 200
+        t_baseline = timeit.timeit(lambda: maximal_marginal_relevance(query, candidate_list, lambda_mult=0.5, k=K),
+                                   number=number) / number
+        t_ours = timeit.timeit(lambda: mmr_select(query, candidates, k=K, lambda_mult=0.5), number=number) / number
+        print(f"{fetch_k:>8} {t_baseline * 1000:>14.3f} {t_ours * 1000:>10.3f} {t_baseline / t_ours:>7.1f}x  "
+              f"{list(baseline) == ours}")
+
+
+if __name__ == '__main__':
+    main()
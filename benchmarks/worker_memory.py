@@ -0,0 +1,45 @@
+"""Report per-process memory of a running serve_prefork.py server.
+
+PSS (proportional set size) splits every shared page between the processes mapping it, so
+the PSS of a worker is its real incremental cost; RSS counts shared weights in full for
+every worker and overstates the total.
+
+Usage: python -m benchmarks.worker_memory <parent pid>
+"""
+import sys
+from pathlib import Path
+
+
+def children(pid: int) -> list[int]:
+    pids = []
+    for task in Path(f'/proc/{pid}/task').iterdir():
+        content = (task / 'children').read_text().split()
+        pids.extend(int(child) for child in content)
+    return pids
+
+
+def rollup(pid: int) -> dict:
+    values = {}
+    for line in Path(f'/proc/{pid}/smaps_rollup').read_text().splitlines()[1:]:
+        key, value = line.split(':', 1)
+        values[key] = int(value.split()[0]) / 1024     # kB -> MiB
+    return values
+
+
+def main():
+    parent = int(sys.argv[1])
+    rows = [('parent', parent)] + [('worker', pid) for pid in children(parent)]
+    print(f"{'role':<8} {'pid':>8} {'RSS MiB':>10} {'PSS MiB':>10} {'shared MiB':>11} {'private MiB':>12}")
+    total_rss = total_pss = 0.0
+    for role, pid in rows:
+        m = rollup(pid)
+        shared = m.get('Shared_Clean', 0) + m.get('Shared_Dirty', 0)
+        private = m.get('Private_Clean', 0) + m.get('Private_Dirty', 0)
+        total_rss += m['Rss']
+        total_pss += m['Pss']
+        print(f"{role:<8} {pid:>8} {m['Rss']:>10.1f} {m['Pss']:>10.1f} {shared:>11.1f} {private:>12.1f}")
+    print(f"{'total':<8} {'':>8} {total_rss:>10.1f} {total_pss:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
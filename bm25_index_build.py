@@ -0,0 +1,19 @@
+#%% 1.Import libraries
+import os                                                           # Functions for interacting with the operating system
+import sys                                                          # Command line arguments
+from glob import glob                                               # File name pattern matching
+from dotenv import load_dotenv                                      # Reads .env files and sets environment variables
+
+from llmodels.bm25 import build_bm25_index
+
+#%% 2.Set parameters and environment variables
+load_dotenv()
+
+# Usage: python bm25_index_build.py [chunk jsonl files...]
+# Run again with the chunk files of recrawled pages: their sources are replaced, all others kept.
+chunk_files = sys.argv[1:] or glob(os.path.join('data_crawler', 'crawled_data', '*.jsonl'))
+index_path = os.environ.get('BM25_INDEX', os.path.join(os.environ.get('LOCAL_INDEX_DIR', 'local_index'), 'bm25.sqlite'))
+
+#%% 3.Tokenize chunks and update the inverted index
+index = build_bm25_index(chunk_files, index_path)
+print(f"BM25 index {index_path}: {len(index)} chunks after indexing {len(chunk_files)} chunk file(s)")
@@ -0,0 +1,131 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Callable, Optional
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed; maps to an HTTP status with a Retry-After header."""
+
+    def __init__(self, status_code: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Ticket:
+    """A granted slot. `release()` is idempotent so it can sit in several cleanup paths."""
+
+    def __init__(self, controller: 'AdmissionController'):
+        self._controller = controller
+        self._start = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(time.monotonic() - self._start)
+
+
+class AdmissionController:
+    """Concurrency limiter with a bounded FIFO wait queue.
+
+    At most `max_concurrency` requests hold a slot; up to `max_queue` more wait for one.
+    A request arriving at a full queue is rejected with 429, and a queued request that has
+    not been admitted within `queue_timeout` seconds is rejected with 503. Both carry a
+    Retry-After estimated from the recent slot hold time. `on_change`, if set, is called
+    whenever `active` or `queue_depth` changes.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.wait_seconds_sum = 0.0
+        self.wait_seconds_max = 0.0
+        self.queued_total = 0
+        self._hold_seconds = 1.0    # moving average of how long a slot is held
+        self._waiters: deque[asyncio.Future] = deque()
+        self.on_change: Optional[Callable[[], None]] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def retry_after(self) -> int:
+        waves = (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, math.ceil(waves * self._hold_seconds))
+
+    def _admit(self, waited: float) -> Ticket:
+        self.admitted += 1
+        if waited > 0:
+            self.queued_total += 1
+            self.wait_seconds_sum += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        return Ticket(self)
+
+    async def acquire(self) -> Ticket:
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            self._changed()
+            return self._admit(0.0)
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise AdmissionRejected(429, self.retry_after(), "Too many requests waiting")
+
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._changed()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up: pass it on.
+                if isinstance(e, asyncio.CancelledError):
+                    self._release(0.0, count_hold=False)
+                    raise
+                return self._admit(time.monotonic() - start)
+            waiter.cancel()
+            self._waiters.remove(waiter)
+            self._changed()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rejected_timeout += 1
+            raise AdmissionRejected(503, self.retry_after(), "Timed out waiting for capacity")
+        return self._admit(time.monotonic() - start)
+
+    def _release(self, held: float, count_hold: bool = True):
+        if count_hold:
+            self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * held
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)     # the slot moves to the waiter, `active` is unchanged
+                self._changed()
+                return
+        self.active -= 1
+        self._changed()
+
+    def stats(self) -> dict:
+        return {
+            'max_concurrency': self.max_concurrency,
+            'active': self.active,
+            'queue_depth': len(self._waiters),
+            'max_queue': self.max_queue,
+            'admitted': self.admitted,
+            'rejected_queue_full': self.rejected_queue_full,
+            'rejected_timeout': self.rejected_timeout,
+            'queue_wait_seconds_avg': self.wait_seconds_sum / self.queued_total if self.queued_total else 0.0,
+            'queue_wait_seconds_max': self.wait_seconds_max,
+        }
@@ -0,0 +1,232 @@
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+import jsonlines
+import numpy as np
+from langchain.schema import Document
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+STOPWORDS = {
+    # English
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'for', 'from', 'how', 'i', 'if', 'in', 'is',
+    'it', 'my', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'which', 'who',
+    'will', 'with', 'you', 'your',
+    # Swedish
+    'och', 'att', 'det', 'som', 'en', 'ett', 'är', 'av', 'för', 'på', 'med', 'till', 'den', 'har', 'de', 'om',
+    'du', 'inte', 'kan', 'vi', 'ska', 'eller',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    chunk_id TEXT NOT NULL,
+    title TEXT,
+    updated TEXT,
+    text TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    UNIQUE (source, chunk_id)
+);
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT PRIMARY KEY,
+    df INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+CREATE INDEX IF NOT EXISTS docs_source ON docs (source);
+"""
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 over the chunks, stored as an inverted index in one SQLite file.
+
+    Exact terms that the embedding model handles poorly (personnummer, uppehållstillstånd,
+    form numbers) are matched literally. Documents are keyed by (source, chunk-id), or by
+    (source, text hash) for chunks without a chunk-id, and `replace_sources` swaps all chunks
+    of recrawled pages in one transaction, so the index is updated incrementally instead of
+    rebuilt.
+
+    Reads use one connection per thread, so searches can run in worker threads in parallel.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75, text_key: str = 'text'):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.text_key = text_key
+        self._local = threading.local()
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    #######################
+    # Updates
+    #######################
+
+    def _delete_source(self, db: sqlite3.Connection, source: str):
+        rows = db.execute('SELECT id FROM docs WHERE source = ?', (source,)).fetchall()
+        for (doc,) in rows:
+            terms = db.execute('SELECT term FROM postings WHERE doc = ?', (doc,)).fetchall()
+            db.executemany('UPDATE terms SET df = df - 1 WHERE term = ?', terms)
+            db.execute('DELETE FROM postings WHERE doc = ?', (doc,))
+        db.execute('DELETE FROM docs WHERE source = ?', (source,))
+
+    def _insert(self, db: sqlite3.Connection, chunk: dict):
+        counts = Counter(tokenize(chunk['chunk']))
+        cursor = db.execute(
+            'INSERT INTO docs (source, chunk_id, title, updated, text, length) VALUES (?, ?, ?, ?, ?, ?)',
+            (chunk['source'], chunk_key(chunk), chunk.get('title'), chunk.get('updated'), chunk['chunk'],
+             sum(counts.values())))
+        doc = cursor.lastrowid
+        db.executemany('INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)',
+                       [(term, doc, tf) for term, tf in counts.items()])
+        db.executemany('INSERT INTO terms (term, df) VALUES (?, 1) ON CONFLICT (term) DO UPDATE SET df = df + 1',
+                       [(term,) for term in counts])
+
+    def replace_sources(self, chunks: Iterable[dict]) -> int:
+        """Index `chunks` (entries written by `Crawler.write_chunk_text`), replacing every chunk
+        previously indexed for the same sources. Returns the number of chunks indexed.
+
+        A chunk repeated in `chunks` (chunk files written in append mode by several crawls)
+        is indexed once, with its last version."""
+        by_source = {}
+        for chunk in chunks:
+            by_source.setdefault(chunk['source'], {})[chunk_key(chunk)] = chunk
+        db = self._connect()
+        with db:
+            for source, source_chunks in by_source.items():
+                self._delete_source(db, source)
+                for chunk in source_chunks.values():
+                    self._insert(db, chunk)
+            db.execute('DELETE FROM terms WHERE df <= 0')
+        return sum(len(c) for c in by_source.values())
+
+    def remove_sources(self, sources: Iterable[str]):
+        db = self._connect()
+        with db:
+            for source in sources:
+                self._delete_source(db, source)
+            db.execute('DELETE FROM terms WHERE df <= 0')
+
+    #######################
+    # Search
+    #######################
+
+    def search(self, query: str, k: int = 20) -> List[Tuple[Document, float]]:
+        """The `k` best chunks for `query` by BM25 score, best first."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        db = self._connect()
+        n_docs, total_length = db.execute('SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs').fetchone()
+        if n_docs == 0:
+            return []
+        avg_length = total_length / n_docs
+
+        scores = {}
+        for term in terms:
+            row = db.execute('SELECT df FROM terms WHERE term = ?', (term,)).fetchone()
+            if row is None:
+                continue
+            idf = math.log(1 + (n_docs - row[0] + 0.5) / (row[0] + 0.5))
+            postings = db.execute('SELECT p.doc, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.doc '
+                                  'WHERE p.term = ?', (term,)).fetchall()
+            if not postings:
+                continue
+            docs, tf, length = np.array(postings, dtype=np.float64).T
+            term_scores = idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+            for doc, score in zip(docs.astype(np.int64).tolist(), term_scores.tolist()):
+                scores[doc] = scores.get(doc, 0.0) + score
+        if not scores:
+            return []
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        placeholders = ','.join('?' * len(best))
+        rows = {row[0]: row for row in db.execute(
+            f'SELECT id, source, chunk_id, title, updated, text FROM docs WHERE id IN ({placeholders})',
+            [doc for doc, _ in best])}
+        results = []
+        for doc, score in best:
+            _, source, chunk_id, title, updated, text = rows[doc]
+            metadata = {'source': source, 'chunk-id': chunk_id, 'title': title, 'updated': updated}
+            results.append((Document(page_content=text, metadata=metadata), score))
+        return results
+
+    def __len__(self) -> int:
+        return self._connect().execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+
+def build_bm25_index(chunk_files: List[str], path: str) -> BM25Index:
+    """Create or update the BM25 index at `path` from chunk jsonl files.
+
+    Parameters
+    ----------
+    chunk_files : list[str]
+        Paths to jsonl files with 'chunk', 'source', 'title', 'chunk-id' and 'updated' fields
+    path : str
+        SQLite file of the index, created if missing. Sources already in the index are
+        replaced by their chunks in `chunk_files`; other sources are kept.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    index = BM25Index(path)
+    chunks = []
+    for chunk_file in chunk_files:
+        with jsonlines.open(chunk_file, 'r') as f:
+            chunks.extend(f)
+    index.replace_sources(chunks)
+    return index
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def chunk_key(chunk: dict) -> str:
+    """Id of a chunk within its source: the chunk-id, or the hash of the text if it has none."""
+    chunk_id = chunk.get('chunk-id')
+    return str(chunk_id) if chunk_id is not None else text_hash(chunk['chunk'])
+
+
+def doc_key(document: Document) -> Tuple[str, str]:
+    """Identity of a chunk across the vector store and the BM25 index.
+
+    The Pinecone index written by pinecone_upload.py has no chunk-id, so chunks are told
+    apart by their text, which both stores hold.
+    """
+    return document.metadata.get('source'), text_hash(document.page_content)
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int = 60) -> List[Tuple[Document, float]]:
+    """Fuse ranked lists by summing 1 / (k + rank) per chunk (`doc_key`). Best first."""
+    fused, documents = {}, {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            key = doc_key(document)
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank + 1)
+            documents.setdefault(key, document)
+    order = sorted(fused, key=fused.get, reverse=True)
+    return [(documents[key], fused[key]) for key in order]
@@ -0,0 +1,96 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class CacheEntry:
+    def __init__(self, question: str, tokens: list[str], expires_at: float, sources: list[dict] = None):
+        self.question = question
+        self.tokens = tokens
+        self.expires_at = expires_at
+        self.sources = sources
+
+
+class SemanticCache:
+    """Answer cache keyed by question embeddings.
+
+    A lookup hits when the cosine similarity between the new question and a stored one is
+    at least `threshold`. Entries expire after `ttl` seconds and the least recently used
+    entry is evicted once `max_entries` is reached. Vectors live in a preallocated matrix so
+    a lookup is a single matrix-vector product.
+    """
+
+    def __init__(self, threshold: float = 0.92, ttl: float = 3600, max_entries: int = 1024):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[int, CacheEntry] = OrderedDict()  # slot -> entry, oldest first
+        self._matrix = None
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _drop(self, slot: int):
+        del self._entries[slot]
+        self._valid[slot] = False
+
+    def lookup(self, vector) -> CacheEntry | None:
+        """Return the cached entry closest to `vector`, or None on a miss."""
+        if not self._entries:
+            self.misses += 1
+            return None
+        # Expired entries are dropped first, so an expired best match does not hide a valid one
+        for slot in np.flatnonzero(self._valid & (self._expires < time.monotonic())).tolist():
+            self._drop(slot)
+        vector = self._normalize(vector)
+        scores = self._matrix @ vector
+        scores[~self._valid] = -np.inf
+        slot = int(np.argmax(scores))
+        if scores[slot] < self.threshold:
+            self.misses += 1
+            return None
+        entry = self._entries[slot]
+        self._entries.move_to_end(slot)
+        self.hits += 1
+        return entry
+
+    def store(self, vector, question: str, tokens: list[str], sources: list[dict] = None):
+        if not self.enabled:
+            return
+        vector = self._normalize(vector)
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        now = time.monotonic()
+        for slot in [s for s, e in self._entries.items() if e.expires_at < now]:
+            self._drop(slot)
+        if len(self._entries) >= self.max_entries:
+            self._drop(next(iter(self._entries)))
+        slot = int(np.argmin(self._valid))
+        self._matrix[slot] = vector
+        self._valid[slot] = True
+        self._expires[slot] = now + self.ttl
+        self._entries[slot] = CacheEntry(question, tokens, now + self.ttl, sources)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+        }
@@ -0,0 +1,134 @@
+from typing import Callable, List, Optional
+
+from langchain.schema import Document
+
+from llmodels.metrics import timed
+
+
+def _chunk_id(document: Document) -> Optional[int]:
+    try:
+        return int(document.metadata.get('chunk-id'))
+    except (TypeError, ValueError):
+        return None
+
+
+def overlap(left: str, right: str, max_overlap: int, min_overlap: int) -> int:
+    """Length of the longest suffix of `left` that is also a prefix of `right`."""
+    for size in range(min(len(left), len(right), max_overlap), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+class Passage:
+    """Text of one or more adjacent chunks of the same source, merged without their overlap."""
+
+    def __init__(self, document: Document, rank: int):
+        self.text = document.page_content
+        self.metadata = dict(document.metadata)
+        self.rank = rank    # best retrieval rank among the merged chunks
+        chunk_id = _chunk_id(document)
+        self.first_id = self.last_id = chunk_id
+        self.chunk_ids = [document.metadata.get('chunk-id')]
+
+    def absorb(self, document: Document, rank: int, max_overlap: int, min_overlap: int) -> bool:
+        """Merge `document` into this passage if it repeats or continues it."""
+        text = document.page_content
+        if text in self.text:
+            self.rank = min(self.rank, rank)
+            return True
+        chunk_id = _chunk_id(document)
+        known = chunk_id is not None and self.first_id is not None
+        if not known or chunk_id == self.last_id + 1:
+            size = overlap(self.text, text, max_overlap, min_overlap)
+            if size or known:
+                # Neighbouring chunks are contiguous text even when the splitter left no overlap
+                self.text += text[size:] if size else ' ' + text
+                self.last_id = chunk_id
+                self.chunk_ids.append(document.metadata.get('chunk-id'))
+                self.rank = min(self.rank, rank)
+                return True
+        if not known or chunk_id == self.first_id - 1:
+            size = overlap(text, self.text, max_overlap, min_overlap)
+            if size or known:
+                self.text = text + (self.text[size:] if size else ' ' + self.text)
+                self.first_id = chunk_id
+                self.chunk_ids.insert(0, document.metadata.get('chunk-id'))
+                self.rank = min(self.rank, rank)
+                return True
+        return False
+
+    def to_document(self, text: str = None) -> Document:
+        metadata = dict(self.metadata, **{'chunk-id': ','.join(str(i) for i in self.chunk_ids)})
+        return Document(page_content=self.text if text is None else text, metadata=metadata)
+
+
+class ContextPacker:
+    """Turns the retrieved chunks into the context of the QA prompt.
+
+    Chunks are written with `chunk_overlap` characters shared between neighbours, so two
+    retrieved chunks of the same `source` often repeat text. Here chunks contained in
+    another one are dropped, adjacent chunks (consecutive `chunk-id`s) are merged with the
+    overlap removed, and the resulting passages are added best-ranked first until
+    `max_tokens`, counted with the LLM's tokenizer, is reached. The passage that crosses
+    the budget is cut at a sentence or word boundary if at least `min_tokens` fit.
+
+    `overhead_tokens` is charged per passage for the "Source URL: ..." header that
+    `document_prompt` adds around it.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], max_tokens: int = 1024, max_overlap: int = 400,
+                 min_overlap: int = 20, min_tokens: int = 64, overhead_tokens: int = 24):
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.max_overlap = max_overlap
+        self.min_overlap = min_overlap
+        self.min_tokens = min_tokens
+        self.overhead_tokens = overhead_tokens
+
+    def merge(self, documents: List[Document]) -> List[Passage]:
+        passages: List[Passage] = []
+        by_source = {}
+        # Lowest chunk-id first, so a run of neighbours is merged left to right
+        order = sorted(range(len(documents)), key=lambda i: (_chunk_id(documents[i]) is None,
+                                                              _chunk_id(documents[i]) or 0, i))
+        for i in order:
+            document = documents[i]
+            group = by_source.setdefault(document.metadata.get('source'), [])
+            if not any(passage.absorb(document, i, self.max_overlap, self.min_overlap) for passage in group):
+                passage = Passage(document, i)
+                group.append(passage)
+                passages.append(passage)
+        return sorted(passages, key=lambda passage: passage.rank)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Longest prefix of `text` ending at a sentence (or else word) boundary within `max_tokens`."""
+        tokens = self.count_tokens(text)
+        end = int(len(text) * max_tokens / tokens)
+        while end > 0:
+            cut = text[:end]
+            boundary = max(cut.rfind('. '), cut.rfind('\n'))
+            if boundary < len(cut) // 2:
+                boundary = cut.rfind(' ')
+            cut = cut[:boundary + 1].rstrip() if boundary > 0 else cut
+            if self.count_tokens(cut) <= max_tokens:
+                return cut
+            end = int(end * 0.9)
+        return ''
+
+    def pack(self, documents: List[Document]) -> List[Document]:
+        with timed('pack'):
+            packed, budget = [], self.max_tokens
+            for passage in self.merge(documents):
+                budget -= self.overhead_tokens
+                tokens = self.count_tokens(passage.text)
+                if tokens <= budget:
+                    packed.append(passage.to_document())
+                    budget -= tokens
+                    continue
+                if budget >= self.min_tokens:
+                    text = self.truncate(passage.text, budget)
+                    if text:
+                        packed.append(passage.to_document(text))
+                break
+            return packed
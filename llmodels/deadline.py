@@ -0,0 +1,138 @@
+"""Per-request deadline, checked by every stage of a /q request.
+
+The deadline starts when the request arrives and is seen by every task the request creates
+through a context variable, like the RequestTimer. The stages before generation (embed,
+vector search, keyword search, rerank) may only use the time up to `expires - reserve`.
+The `reserve` is left for generation. When time runs short, the stages degrade instead of
+failing:
+
+- semantic cache: skipped if the question cannot be embedded in time
+- rerank: bounded by the time left, and skipped if none is left (retrieval order is kept)
+- embed + vector search: past their budget, the BM25 ranking is used alone if hybrid
+  search is on; without it the request fails with DeadlineExceeded. A late BM25 search
+  is dropped in the same way when the vector search made it
+- chunks: if less than twice the reserve is left after retrieval, fewer chunks go into
+  the prompt, in proportion (at least one), so prompt evaluation is shorter
+- max_tokens: the answer is limited to what the backend can generate in the time left,
+  at its typical speed (at least `min_tokens`)
+- generation: stopped at the deadline; what has been streamed so far stays with the client
+"""
+import asyncio
+import contextvars
+import time
+from typing import Any, Awaitable, Optional, TypeVar
+
+from langchain.callbacks.base import AsyncCallbackHandler
+
+T = TypeVar('T')
+
+_current_deadline: contextvars.ContextVar[Optional['Deadline']] = contextvars.ContextVar('request_deadline',
+                                                                                          default=None)
+
+deadline_stats = {
+    'exceeded': {},     # stage -> requests that ran out of time in it
+    'degraded': {},     # degradation -> requests
+}
+
+
+def count(kind: str, what: str):
+    deadline_stats[kind][what] = deadline_stats[kind].get(what, 0) + 1
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    def __init__(self, stage: str):
+        super().__init__(f"Deadline exceeded in {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Time budget of one request.
+
+    `reserve` seconds are kept for generation, which runs at about `tokens_per_second`
+    after a first token delay of `first_token_seconds`. Answers are planned to end within
+    `margin` of the time left, as the speed varies. `shortened` marks a deadline the client
+    asked to be shorter than the backend's.
+    """
+
+    def __init__(self, seconds: float, reserve: float, tokens_per_second: float, first_token_seconds: float,
+                 min_tokens: int = 32, margin: float = 0.8, shortened: bool = False):
+        self.seconds = seconds
+        self.shortened = shortened
+        self.expires = time.monotonic() + seconds
+        self.reserve = min(reserve, seconds / 2)
+        self.tokens_per_second = tokens_per_second
+        self.first_token_seconds = first_token_seconds
+        self.min_tokens = min_tokens
+        self.margin = margin
+        self.degraded = []      # degradations used; an answer made with any of them is not cached
+
+    def activate(self):
+        """Make this the deadline seen by `current_deadline()` in this task and the tasks it creates."""
+        _current_deadline.set(self)
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    def retrieval_remaining(self) -> float:
+        """Seconds the stages before generation may still use."""
+        return self.remaining() - self.reserve
+
+    def degrade(self, what: str):
+        self.degraded.append(what)
+        count('degraded', what)
+
+    async def bound(self, awaitable: Awaitable[T], stage: str, retrieval: bool = True) -> T:
+        """Await `awaitable` for at most the time left (before the reserve, if `retrieval`)."""
+        timeout = self.retrieval_remaining() if retrieval else self.remaining()
+        try:
+            return await asyncio.wait_for(awaitable, max(timeout, 0))
+        except asyncio.TimeoutError:
+            count('exceeded', stage)
+            raise DeadlineExceeded(stage) from None
+
+    def chunks(self, k: int) -> int:
+        """How many of the `k` chunks to put in the prompt with the time that is left."""
+        remaining = self.remaining()
+        if remaining >= 2 * self.reserve or k <= 1:
+            return k
+        fewer = max(1, int(k * remaining / (2 * self.reserve)))
+        if fewer < k:
+            self.degrade('fewer_chunks')
+        return fewer
+
+    def max_tokens(self, default: int) -> int:
+        """Answer tokens the backend can generate in the time that is left, up to `default`."""
+        affordable = int((self.remaining() * self.margin - self.first_token_seconds) * self.tokens_per_second)
+        if affordable >= default:
+            return default
+        self.degrade('shorter_answer')
+        return max(self.min_tokens, affordable)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+async def bounded(awaitable: Awaitable[T], stage: str, retrieval: bool = True) -> T:
+    """`Deadline.bound` with the current request's deadline; just awaits outside of a request."""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return await awaitable
+    return await deadline.bound(awaitable, stage, retrieval)
+
+
+class AnswerTokenLimit(AsyncCallbackHandler):
+    """Chain callback limiting the answer to `deadline.max_tokens` once retrieval is done.
+
+    `llm_kwargs` is the `llm_kwargs` dict of the chain's answer LLMChain, which passes it to
+    the LLM call that follows the retrieval. The caller removes the limit again when the
+    chain is done, before it goes back to the pool.
+    """
+
+    def __init__(self, deadline: Deadline, llm_kwargs: dict, max_tokens: int):
+        self.deadline = deadline
+        self.llm_kwargs = llm_kwargs
+        self.default = max_tokens
+
+    async def on_retriever_end(self, documents, **kwargs: Any):
+        self.llm_kwargs['max_tokens'] = self.deadline.max_tokens(self.default)
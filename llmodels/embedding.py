@@ -0,0 +1,167 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain.schema.embeddings import Embeddings
+
+
+def normalize_query(text: str) -> str:
+    """Cache key for a query. all-MiniLM-L6-v2 is uncased and ignores repeated whitespace,
+    so queries that only differ in case or spacing share the same embedding."""
+    return ' '.join(text.lower().split())
+
+
+class EmbeddingService(Embeddings):
+    """Query embedding front-end for the sentence-transformer model.
+
+    - query vectors are kept in a bounded LRU cache keyed by the normalized query text
+    - concurrent `aembed_query` calls that arrive within `max_wait_ms` of each other are
+      merged into a single `embed_documents` (one `encode`) call of at most `max_batch` texts
+    - encoding runs on a dedicated thread so the event loop keeps serving other requests
+    """
+
+    def __init__(self, model, cache_size: int = 4096, max_batch: int = 32, max_wait_ms: float = 3):
+        self._model = model     # an Embeddings instance, or a callable returning one on first use
+        self.cache_size = cache_size
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_queries = 0
+        self._cache: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embed')
+        self._pending: dict[str, tuple[str, asyncio.Future]] = {}
+        self._flush_handle = None
+        self._loop = None
+
+    @property
+    def model(self) -> Embeddings:
+        return self._model() if callable(self._model) else self._model
+
+    #######################
+    # LRU cache
+    #######################
+
+    def _cache_get(self, key: str):
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def _cache_put(self, key: str, vector: list[float]):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    #######################
+    # Micro-batcher
+    #######################
+
+    def _schedule_flush(self):
+        if len(self._pending) >= self.max_batch:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            self._loop.create_task(self._flush())
+        elif self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(self.max_wait, lambda: self._loop.create_task(self._flush()))
+
+    async def _flush(self):
+        self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        keys = list(batch)
+        texts = [batch[key][0] for key in keys]
+        self.batches += 1
+        self.batched_queries += len(texts)
+        try:
+            vectors = await self._loop.run_in_executor(self._executor, self.embed_documents, texts)
+        except Exception as e:
+            for _, future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, vector in zip(keys, vectors):
+            self._cache_put(key, vector)
+            future = batch[key][1]
+            if not future.done():
+                future.set_result(vector)
+
+    #######################
+    # Embeddings interface
+    #######################
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = normalize_query(text)
+        vector = self._cache_get(key)
+        if vector is not None:
+            return vector
+        self._loop = asyncio.get_running_loop()
+        if key in self._pending:
+            future = self._pending[key][1]
+        else:
+            future = self._loop.create_future()
+            self._pending[key] = (text, future)
+            self._schedule_flush()
+        # shield: one cancelled request must not fail the other queries in its batch
+        return await asyncio.shield(future)
+
+    def embed_query(self, text: str) -> list[float]:
+        try:
+            asyncio.get_running_loop()
+            on_loop = True
+        except RuntimeError:
+            on_loop = False
+        if not on_loop and self._loop is not None and self._loop.is_running():
+            # Called from a worker thread (e.g. a sync vector store call run in an executor):
+            # join the batch on the serving loop.
+            return asyncio.run_coroutine_threadsafe(self.aembed_query(text), self._loop).result()
+
+        key = normalize_query(text)
+        vector = self._cache_get(key)
+        if vector is None:
+            vector = self.model.embed_query(text)
+            self._cache_put(key, vector)
+        return vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.model.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.embed_documents, texts)
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        """Query vectors for many texts at once: the uncached ones in one `embed_documents` call."""
+        keys = [normalize_query(text) for text in texts]
+        vectors = [self._cache_get(key) for key in keys]
+        missing = {key: text for key, text, vector in zip(keys, texts, vectors) if vector is None}
+        if missing:
+            self.batches += 1
+            self.batched_queries += len(missing)
+            embedded = dict(zip(missing, await self.aembed_documents(list(missing.values()))))
+            for key, vector in embedded.items():
+                self._cache_put(key, vector)
+            vectors = [vector if vector is not None else embedded[key] for key, vector in zip(keys, vectors)]
+        return vectors
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'cache_hit_rate': self.hits / lookups if lookups else 0.0,
+            'batches': self.batches,
+            'avg_batch_size': self.batched_queries / self.batches if self.batches else 0.0,
+        }
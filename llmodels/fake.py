@@ -0,0 +1,157 @@
+"""Deterministic stand-ins for the LLM, the embedding model and the vector store.
+
+Selected with LLM_BACKEND=fake, EMBED_MODEL_ID=fake and VECTOR_BACKEND=fake, so the whole
+serving path (admission, embedding batcher, retrieval, chain, frame streaming) can be
+load-tested offline without OpenAI, Pinecone or model downloads.
+"""
+import asyncio
+import hashlib
+import os
+import random
+import time
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+from langchain.schema.embeddings import Embeddings
+
+MAX_TOKENS = int(os.environ.get('FAKE_LLM_TOKENS', 128))
+MAX_CONCURRENCY = 64
+# One chain per admitted request, so admission is the only queue
+POOL_SIZE = MAX_CONCURRENCY
+MAX_QUEUE = 256
+QUEUE_TIMEOUT = 10
+CONTEXT_TOKENS = 1024
+SUMMARIZE_HISTORY = True
+REQUEST_DEADLINE = 30
+TOKENS_PER_SECOND = 1000 / float(os.environ.get('FAKE_LLM_TOKEN_MS', 20))
+FIRST_TOKEN_SECONDS = float(os.environ.get('FAKE_LLM_FIRST_TOKEN_MS', 200)) / 1000
+
+WORDS = ('studera', 'Sweden', 'tuition', 'fee', 'residence', 'permit', 'Migrationsverket', 'university',
+         'application', 'semester', 'SEK', 'personnummer', 'Skatteverket', 'housing', 'scholarship', 'the',
+         'a', 'is', 'for', 'and', 'of', 'to', 'in', 'you', 'must', 'apply', 'before', 'deadline')
+
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class FakeStreamingLLM(LLM):
+    """Streams `max_tokens` pseudo-random words chosen from the prompt's hash.
+
+    `first_token_ms` is the delay before the first token (prompt evaluation / network),
+    `token_ms` the delay between tokens. A fraction `stall_rate` of the calls waits
+    `stall_ms` longer for the first token, like a stalled API.
+    """
+
+    max_tokens: int = MAX_TOKENS
+    first_token_ms: float = float(os.environ.get('FAKE_LLM_FIRST_TOKEN_MS', 200))
+    token_ms: float = float(os.environ.get('FAKE_LLM_TOKEN_MS', 20))
+    stall_rate: float = float(os.environ.get('FAKE_LLM_STALL_RATE', 0))
+    stall_ms: float = float(os.environ.get('FAKE_LLM_STALL_MS', 10000))
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-streaming'
+
+    def _tokens(self, prompt: str, max_tokens: Optional[int] = None) -> List[str]:
+        rng = np.random.default_rng(_seed(prompt))
+        count = max_tokens or self.max_tokens
+        return [' ' + WORDS[i] for i in rng.integers(0, len(WORDS), size=count)]
+
+    def _first_token_delay(self) -> float:
+        stalled = self.stall_rate and random.random() < self.stall_rate
+        return (self.first_token_ms + (self.stall_ms if stalled else 0)) / 1000
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        tokens = self._tokens(prompt, kwargs.get('max_tokens'))
+        time.sleep(self._first_token_delay())
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(self.token_ms / 1000)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+        return ''.join(tokens)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        tokens = self._tokens(prompt, kwargs.get('max_tokens'))
+        await asyncio.sleep(self._first_token_delay())
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(self.token_ms / 1000)
+            if run_manager:
+                await run_manager.on_llm_new_token(token)
+        return ''.join(tokens)
+
+
+def build_llm(stream_callback=None):
+    callbacks = [stream_callback] if stream_callback is not None else None
+    return FakeStreamingLLM(callbacks=callbacks)
+
+def use_shared_session():
+    pass
+
+def count_tokens(text: str) -> int:
+    return len(text.split())
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words embeddings: texts sharing words get similar vectors.
+
+    `encode_ms` per call emulates the CPU cost of a sentence-transformer forward pass.
+    """
+
+    def __init__(self, dimension: int = 384, encode_ms: float = float(os.environ.get('FAKE_EMBED_MS', 5))):
+        self.dimension = dimension
+        self.encode_ms = encode_ms
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in text.lower().split():
+            vector[_seed(word) % self.dimension] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.encode_ms / 1000)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeCrossEncoder:
+    """Scores (query, passage) pairs by word overlap; `predict_ms` per pair emulates a
+    MiniLM cross-encoder on CPU."""
+
+    def __init__(self, predict_ms: float = float(os.environ.get('FAKE_RERANK_MS', 2))):
+        self.predict_ms = predict_ms
+
+    def predict(self, pairs) -> np.ndarray:
+        time.sleep(self.predict_ms * len(pairs) / 1000)
+        return np.array([len(set(query.lower().split()) & set(passage.lower().split())) / (1 + len(query.split()))
+                         for query, passage in pairs], dtype=np.float32)
+
+
+def build_vectorstore(embedding: Embeddings, text_key: str = 'text', size: int = None):
+    """In-memory LocalVectorStore over a synthetic corpus of `size` chunks."""
+    from llmodels.local_index import LocalVectorStore
+    from llmodels.mmr import normalize
+
+    size = size or int(os.environ.get('FAKE_CORPUS_SIZE', 2000))
+    rng = np.random.default_rng(0)
+    metadata = []
+    for i in range(size):
+        words = ' '.join(WORDS[j] for j in rng.integers(0, len(WORDS), size=120))
+        metadata.append({
+            text_key: f'Chunk {i}. {words}',
+            'source': f'https://example.se/page-{i // 5}',
+            'title': f'Page {i // 5}',
+            'chunk-id': str(i % 5),
+            'updated': '2023-07-13',
+        })
+    vectors = np.asarray(embedding.embed_documents([m[text_key] for m in metadata]), dtype=np.float32)
+    return LocalVectorStore(normalize(vectors), metadata, embedding, text_key)
@@ -1,4 +1,45 @@
 from langchain.llms import OpenAI
+import aiohttp
+import openai
 
-def build_llm(stream_callback):
-    return OpenAI(temperature=0, model_name='text-davinci-003',request_timeout=120,streaming=True,callbacks=[stream_callback])
\ No newline at end of file
+# Completion budget per answer, also used to estimate the tokens saved by cancelling
+MAX_TOKENS = 256
+# Admission control defaults for /q, overridable with GPT3_MAX_CONCURRENCY, GPT3_MAX_QUEUE, GPT3_QUEUE_TIMEOUT.
+# Every admitted request must find a free chain (POOL_SIZE >= MAX_CONCURRENCY), so admission is the only queue.
+MAX_CONCURRENCY = 32
+MAX_QUEUE = 64
+QUEUE_TIMEOUT = 10
+# Token budget for the retrieved context in the QA prompt, overridable with GPT3_CONTEXT_TOKENS
+CONTEXT_TOKENS = 1024
+# Request deadline in seconds (GPT3_REQUEST_DEADLINE), and the generation speed it is planned
+# with (GPT3_TOKENS_PER_SECOND, GPT3_FIRST_TOKEN_SECONDS); see llmodels/deadline.py
+REQUEST_DEADLINE = 30
+TOKENS_PER_SECOND = 30
+FIRST_TOKEN_SECONDS = 1.5
+# OpenAI clients are stateless, so one chain per admitted request can stream at the same time.
+# Kept equal to MAX_CONCURRENCY; a smaller pool would queue admitted requests again.
+POOL_SIZE = MAX_CONCURRENCY
+# Summarize old conversation turns with the model (one extra short completion per compaction)
+SUMMARIZE_HISTORY = True
+
+_aiosession = None
+_encoding = None
+
+def build_llm(stream_callback=None):
+    callbacks = [stream_callback] if stream_callback is not None else None
+    return OpenAI(temperature=0, model_name='text-davinci-003',max_tokens=MAX_TOKENS,request_timeout=120,streaming=True,callbacks=callbacks)
+
+def use_shared_session():
+    """Route the OpenAI calls of the current task through one keep-alive aiohttp session
+    instead of opening a new connection for every completion."""
+    global _aiosession
+    if _aiosession is None or _aiosession.closed:
+        _aiosession = aiohttp.ClientSession()
+    openai.aiosession.set(_aiosession)
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        import tiktoken
+        _encoding = tiktoken.encoding_for_model('text-davinci-003')
+    return len(_encoding.encode(text))
@@ -0,0 +1,176 @@
+"""Router over two LLM backends that hedges stalled requests.
+
+Selected with LLM_BACKEND=hedged. Every call goes to HEDGE_PRIMARY (default gpt3). If it has
+not produced a token within HEDGE_DEADLINE_MS, or fails before its first token, the same
+prompt is also sent to HEDGE_SECONDARY (default llama2). The first of the two to produce a
+token is streamed, and the other is cancelled. A stall after the first token is not hedged.
+"""
+import asyncio
+import importlib
+import os
+from typing import Any, List, Optional
+
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+primary = importlib.import_module(f"llmodels.{os.environ.get('HEDGE_PRIMARY', 'gpt3')}")
+secondary = importlib.import_module(f"llmodels.{os.environ.get('HEDGE_SECONDARY', 'llama2')}")
+DEADLINE_MS = float(os.environ.get('HEDGE_DEADLINE_MS', 3000))
+# Hedges running at once; more would only queue behind each other on a local secondary
+MAX_HEDGES = int(os.environ.get('HEDGE_MAX_IN_FLIGHT', secondary.MAX_CONCURRENCY))
+
+# Sized for the primary; hedges are bounded separately by MAX_HEDGES
+POOL_SIZE = primary.POOL_SIZE
+LOCAL_WEIGHTS = getattr(primary, 'LOCAL_WEIGHTS', False) or getattr(secondary, 'LOCAL_WEIGHTS', False)
+MAX_TOKENS = primary.MAX_TOKENS
+MAX_CONCURRENCY = primary.MAX_CONCURRENCY
+MAX_QUEUE = primary.MAX_QUEUE
+QUEUE_TIMEOUT = primary.QUEUE_TIMEOUT
+# The packed context has to fit either backend's prompt
+CONTEXT_TOKENS = min(primary.CONTEXT_TOKENS, secondary.CONTEXT_TOKENS)
+SUMMARIZE_HISTORY = primary.SUMMARIZE_HISTORY
+# A hedged answer may come from the slower backend
+REQUEST_DEADLINE = max(primary.REQUEST_DEADLINE, secondary.REQUEST_DEADLINE)
+TOKENS_PER_SECOND = min(primary.TOKENS_PER_SECOND, secondary.TOKENS_PER_SECOND)
+FIRST_TOKEN_SECONDS = DEADLINE_MS / 1000 + secondary.FIRST_TOKEN_SECONDS
+
+hedge_stats = {'calls': 0, 'hedged': 0, 'hedge_wins': 0, 'primary_failures': 0, 'hedges_skipped': 0,
+               'hedges_in_flight': 0}
+
+
+class Attempt(AsyncCallbackHandler):
+    """One backend's run of a prompt; collects its tokens and signals `changed` on progress.
+
+    The backend runs through its public `agenerate` with this handler as a callback, so its
+    own callback manager (retries, errors) works as for any other call.
+    """
+
+    def __init__(self, llm, prompt: str, stop: Optional[List[str]], changed: asyncio.Event, hedge: bool = False,
+                 **kwargs: Any):
+        self.tokens: List[str] = []
+        self.changed = changed
+        self.hedge = hedge
+        self.task = asyncio.create_task(llm.agenerate([prompt], stop=stop, callbacks=[self], **kwargs))
+        self.task.add_done_callback(self._done)
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any):
+        self.tokens.append(token)
+        self.changed.set()
+
+    def _done(self, task: asyncio.Task):
+        if not task.cancelled():
+            task.exception()  # retrieved here; raised by result() if this attempt is streamed
+        if self.hedge:
+            hedge_stats['hedges_in_flight'] -= 1
+        self.changed.set()
+
+    @property
+    def failed(self) -> bool:
+        return self.task.done() and not self.task.cancelled() and self.task.exception() is not None
+
+
+def _winner(attempts: List[Attempt]) -> Optional[Attempt]:
+    """The attempt to stream: the first with a token, or the one to report once all have ended."""
+    for attempt in attempts:
+        if attempt.tokens:
+            return attempt
+    if all(attempt.task.done() for attempt in attempts):
+        return next((attempt for attempt in attempts if not attempt.failed), attempts[0])
+    return None
+
+
+class HedgedLLM(LLM):
+    primary: Any  #: :meta private:
+    secondary: Any  #: :meta private:
+    deadline_ms: float = DEADLINE_MS
+
+    @property
+    def _llm_type(self) -> str:
+        return 'hedged'
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return self.primary(prompt, stop=stop, callbacks=run_manager.get_child() if run_manager else None)
+
+    def _hedge(self, prompt: str, stop: Optional[List[str]], changed: asyncio.Event, **kwargs: Any) -> Optional[Attempt]:
+        if hedge_stats['hedges_in_flight'] >= MAX_HEDGES:
+            hedge_stats['hedges_skipped'] += 1
+            return None
+        hedge_stats['hedged'] += 1
+        hedge_stats['hedges_in_flight'] += 1
+        return Attempt(self.secondary, prompt, stop, changed, hedge=True, **kwargs)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        hedge_stats['calls'] += 1
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        attempts = [Attempt(self.primary, prompt, stop, changed, **kwargs)]
+        deadline = loop.time() + self.deadline_ms / 1000
+        may_hedge = True
+        try:
+            while True:
+                changed.clear()
+                winner = _winner(attempts)
+                if may_hedge and (winner is not None and winner.failed or winner is None and loop.time() >= deadline):
+                    may_hedge = False
+                    if winner is not None:
+                        hedge_stats['primary_failures'] += 1
+                    hedge = self._hedge(prompt, stop, changed, **kwargs)
+                    if hedge is not None:
+                        attempts.append(hedge)
+                        continue
+                if winner is not None:
+                    break
+                timeout = deadline - loop.time() if may_hedge else None
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            if winner.hedge:
+                hedge_stats['hedge_wins'] += 1
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.task.cancel()
+
+            position = 0
+            while True:
+                changed.clear()
+                while position < len(winner.tokens):
+                    if run_manager:
+                        await run_manager.on_llm_new_token(winner.tokens[position], verbose=self.verbose)
+                    position += 1
+                if winner.task.done():
+                    break
+                await changed.wait()
+            return winner.task.result().generations[0][0].text
+        finally:
+            for attempt in attempts:
+                attempt.task.cancel()
+
+
+def build_llm(stream_callback=None):
+    callbacks = [stream_callback] if stream_callback is not None else None
+    return HedgedLLM(primary=primary.build_llm(), secondary=secondary.build_llm(), callbacks=callbacks)
+
+def use_shared_session():
+    primary.use_shared_session()
+    secondary.use_shared_session()
+
+def count_tokens(text: str) -> int:
+    return primary.count_tokens(text)
+
+def cache_prompt_prefix(prefix: str):
+    for backend in (primary, secondary):
+        if hasattr(backend, 'cache_prompt_prefix'):
+            backend.cache_prompt_prefix(prefix)
+
+def stats() -> dict:
+    return {
+        'hedge': {**hedge_stats, 'deadline_ms': DEADLINE_MS,
+                  'primary': primary.__name__.split('.')[-1], 'secondary': secondary.__name__.split('.')[-1]},
+        'primary': primary.stats() if hasattr(primary, 'stats') else None,
+        'secondary': secondary.stats() if hasattr(secondary, 'stats') else None,
+    }
@@ -0,0 +1,34 @@
+import threading
+import time
+
+
+class Lazy:
+    """Component built on first use, at most once, even when several threads ask for it.
+
+    Calling the instance returns the component. `ready` and `load_seconds` let the
+    readiness endpoint report which components are loaded.
+    """
+
+    def __init__(self, factory, name: str):
+        self._factory = factory
+        self.name = name
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.load_seconds = None
+
+    @property
+    def ready(self) -> bool:
+        return self._loaded
+
+    def __call__(self):
+        if self._loaded:
+            return self._value
+        with self._lock:
+            if not self._loaded:
+                start = time.monotonic()
+                self._value = self._factory()
+                self.load_seconds = time.monotonic() - start
+                self._loaded = True
+                print(f"{self.name}: ready ({self.load_seconds:.1f}s)")
+        return self._value
@@ -1,14 +1,242 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
 from langchain.llms import CTransformers
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 
+from llmodels.lazy import Lazy
+
 model_id = "TheBloke/Llama-2-7B-chat-GGML"
 model_file="llama-2-7b-chat.ggmlv3.q5_K_M.bin"
 config = {'context_length':2048,'max_new_tokens': 256, 'repetition_penalty': 1.1, 'temperature': 0.1, 'stream': True}
 
-def build_llm(stream_callback):
-    return CTransformers(model=model_id,
+# LLAMA2_WORKERS > 0 serves the model from that many worker processes, each pinned to its
+# own cores (see llmodels/llama_workers.py); 0 runs it in this process.
+WORKERS = int(os.environ.get('LLAMA2_WORKERS', 0))
+
+# LLAMA2_SPECULATIVE=1 decodes with drafted tokens verified in batches (see llmodels/speculative.py)
+SPECULATIVE = os.environ.get('LLAMA2_SPECULATIVE', '0') == '1'
+
+# A single local model cannot generate two answers at once; each worker holds one.
+# MAX_CONCURRENCY below admits exactly this many requests.
+POOL_SIZE = max(1, WORKERS)
+# Weights live in this process, so a pre-forking server loads them once in the parent.
+# With worker processes they live in the workers instead.
+LOCAL_WEIGHTS = WORKERS == 0
+MAX_TOKENS = config['max_new_tokens']
+# Admission control defaults for /q, overridable with LLAMA2_MAX_CONCURRENCY, LLAMA2_MAX_QUEUE, LLAMA2_QUEUE_TIMEOUT.
+# CPU generation takes tens of seconds per answer, so only a short queue is worth keeping.
+# Equal to POOL_SIZE: every admitted request finds a free chain, so admission is the only queue.
+MAX_CONCURRENCY = POOL_SIZE
+MAX_QUEUE = 2 * max(1, WORKERS)
+QUEUE_TIMEOUT = 60
+# Token budget for the retrieved context, overridable with LLAMA2_CONTEXT_TOKENS. Prompt
+# evaluation dominates time-to-first-token on CPU, and the prompt plus the answer must fit
+# in context_length.
+CONTEXT_TOKENS = 1024
+# Request deadline in seconds (LLAMA2_REQUEST_DEADLINE), and the generation speed it is planned
+# with (LLAMA2_TOKENS_PER_SECOND, LLAMA2_FIRST_TOKEN_SECONDS). On CPU the prompt evaluation
+# before the first token takes most of the time.
+REQUEST_DEADLINE = 180
+TOKENS_PER_SECOND = 4
+FIRST_TOKEN_SECONDS = 20
+# An extra generation would hold up the only model instance, so old turns are summarized without it
+SUMMARIZE_HISTORY = False
+
+# Every call into the model runs on this one thread, in submission order. Its thread is only
+# started on first use, so a pre-forking parent that just loads the weights never starts it.
+_model_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='llama')
+_prefix_tokens: List[int] = []
+prefix_stats = {'prompt_tokens': 0, 'prompt_tokens_reused': 0, 'prefix_restores': 0}
+
+
+def _common_prefix(a, b) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _restore_prefix(client):
+    """Evaluate the static prompt prefix again if another prompt has overwritten it."""
+    if not _prefix_tokens or _common_prefix(client._context, _prefix_tokens) == len(_prefix_tokens):
+        return
+    # Truncates the context to what is still shared with the prefix and returns the rest
+    tokens = client.prepare_inputs_for_generation(_prefix_tokens, reset=True)
+    client.eval(tokens)
+    prefix_stats['prefix_restores'] += 1
+
+
+class ThreadStreaming:
+    """LLM calls that run `_generate_tokens` on `_executor()` and stream its tokens back.
+
+    The event loop stays free while the model is busy, and a cancelled call sets the event
+    passed to `_generate_tokens`, which stops at the next token. A `max_tokens` keyword
+    argument stops the generation the same way after that many tokens.
+    """
+
+    @staticmethod
+    def _limit(on_token, cancelled: threading.Event, max_tokens: Optional[int]):
+        if max_tokens is None:
+            return on_token
+        produced = 0
+
+        def limited(token: str):
+            nonlocal produced
+            on_token(token)
+            produced += 1
+            if produced >= max_tokens:
+                cancelled.set()
+        return limited
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        on_token = (lambda token: run_manager.on_llm_new_token(token, verbose=self.verbose)) if run_manager \
+            else (lambda token: None)
+        cancelled = threading.Event()
+        on_token = self._limit(on_token, cancelled, kwargs.get('max_tokens'))
+        return self._executor().submit(self._generate_tokens, prompt, stop, on_token, cancelled).result()
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+        on_token = self._limit(lambda token: loop.call_soon_threadsafe(queue.put_nowait, token), cancelled,
+                               kwargs.get('max_tokens'))
+        future = loop.run_in_executor(self._executor(), self._generate_tokens, prompt, stop, on_token, cancelled)
+        # Scheduled on the loop after every token the thread queued before returning
+        future.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while (token := await queue.get()) is not None:
+                if run_manager:
+                    await run_manager.on_llm_new_token(token, verbose=self.verbose)
+            return await future
+        finally:
+            cancelled.set()
+
+
+def generate_tokens(client, prompt: str, stop: Optional[List[str]], on_token, cancelled) -> str:
+    """Stream an answer from a local model client; `cancelled()` is checked after every token."""
+    tokens = client.tokenize(prompt)
+    prefix_stats['prompt_tokens'] += len(tokens)
+    prefix_stats['prompt_tokens_reused'] += min(_common_prefix(tokens, client._context), len(tokens) - 1)
+    text = []
+    for chunk in client(prompt, stop=stop, stream=True):
+        text.append(chunk)
+        on_token(chunk)
+        if cancelled():
+            break
+    return ''.join(text)
+
+
+class PrefixCachedCTransformers(ThreadStreaming, CTransformers):
+    """CTransformers that keeps the static prefix of the QA prompt evaluated in the model.
+
+    ctransformers keeps the tokens of the previous call in the model context and only
+    evaluates a new prompt after their longest common prefix, so the fixed instruction block
+    of QA_PROMPT costs nothing when the previous call was also an answer. A different prompt
+    in between (the condense-question call) overwrites it. After such a call the prefix is
+    evaluated again on the model thread, before any later call and while the chain is still
+    retrieving, so answer prompts only evaluate the retrieved context and the question.
+    ctransformers cannot save or load KV state, so the prefix is kept resident in the single
+    context instead of snapshotted.
+    """
+
+    def _executor(self) -> ThreadPoolExecutor:
+        return _model_thread
+
+    def _generate_tokens(self, prompt: str, stop: Optional[List[str]], on_token, cancelled: threading.Event) -> str:
+        return run_local(self.client, prompt, stop, on_token, cancelled)
+
+
+def run_local(client, prompt: str, stop: Optional[List[str]], on_token, cancelled: threading.Event) -> str:
+    """Generate on the model thread, then queue a restore of the prompt prefix behind it."""
+    try:
+        return generate_tokens(client, prompt, stop, on_token, cancelled.is_set)
+    finally:
+        _model_thread.submit(_restore_prefix, client)
+
+
+def set_prompt_prefix(client, prefix: str):
+    """Evaluate `prefix` in `client` and restore it after every later call."""
+    global _prefix_tokens
+    # Whitespace at the end may be tokenized together with the text that follows it
+    _prefix_tokens = client.tokenize(prefix.rstrip())
+    _restore_prefix(client)
+
+
+def cache_prompt_prefix(prefix: str):
+    """Evaluate `prefix`, the part of the QA prompt before the retrieved context, and keep it
+    in the model context from now on. Blocks until it is evaluated; called by warmup."""
+    llm = build_llm()
+    if WORKERS:
+        llm.pool.set_prefix(prefix)
+    else:
+        _model_thread.submit(set_prompt_prefix, llm.client, prefix).result()
+
+
+def load_model(threads: Optional[int] = None):
+    if SPECULATIVE:
+        from llmodels.speculative import load_speculative_model
+        return load_speculative_model(threads,
+                                      draft_tokens=int(os.environ.get('LLAMA2_DRAFT_TOKENS', 8)),
+                                      draft_ngram=int(os.environ.get('LLAMA2_DRAFT_NGRAM', 3)))
+    return PrefixCachedCTransformers(model=model_id,
                     model_file=model_file,
                     model_type="llama",
                     lib='avx2',
-                    config=config,
-                    callbacks=[stream_callback])
\ No newline at end of file
+                    config=config if threads is None else {**config, 'threads': threads})
+
+
+_llm = None
+
+def build_llm(stream_callback=None):
+    """Return the shared model, or the client of the worker pool with LLAMA2_WORKERS > 0.
+    The weights are only loaded once per process."""
+    global _llm
+    if _llm is None:
+        if WORKERS:
+            from llmodels.llama_workers import LlamaWorkerPool, PooledLlama
+            _llm = PooledLlama(pool=LlamaWorkerPool(WORKERS))
+        else:
+            _llm = load_model()
+    if stream_callback is None:
+        return _llm
+    return _llm.copy(update={'callbacks': [stream_callback]})
+
+def use_shared_session():
+    pass
+
+def counters() -> dict:
+    """Counters a worker process reports back to the API after each generation."""
+    counters = {'prompt_prefix': prefix_stats}
+    if SPECULATIVE:
+        from llmodels.speculative import speculative_stats
+        counters['speculative'] = speculative_stats
+    return counters
+
+def stats() -> dict:
+    speculative = None
+    if SPECULATIVE:
+        from llmodels import speculative
+        speculative = speculative.stats()
+    return {
+        'prompt_prefix': prefix_stats,
+        'speculative': speculative,
+        'workers': build_llm().pool.stats() if WORKERS and _llm is not None else None,
+    }
+
+def _load_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(os.environ.get('LLAMA2_TOKENIZER', 'hf-internal-testing/llama-tokenizer'))
+
+# Token counts come from a tokenizer-only copy, also without workers: counting runs on the
+# event loop (sessions, context packing) and must not load the weights, or load them a second
+# time next to warmup. Lazy loads it once even when several threads count at the same time.
+_tokenizer = Lazy(_load_tokenizer, "Llama tokenizer")
+
+def count_tokens(text: str) -> int:
+    return len(_tokenizer().encode(text, add_special_tokens=False))
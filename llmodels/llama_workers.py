@@ -0,0 +1,228 @@
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from langchain.llms.base import LLM
+
+from llmodels import llama2
+
+# Cores left to the API process (event loop, embedding model) when pinning the workers
+API_CORES = int(os.environ.get('LLAMA2_API_CORES', 1))
+
+
+def core_sets(workers: int, threads: Optional[int] = None) -> List[List[int]]:
+    """Disjoint core sets for `workers` processes, after reserving API_CORES for the API.
+
+    `threads` cores per worker (LLAMA2_WORKER_THREADS), by default the remaining cores split
+    evenly. If the machine has fewer cores than requested, sets wrap around and overlap.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    if len(cores) > API_CORES:
+        cores = cores[API_CORES:]
+    threads = threads or max(1, len(cores) // workers)
+    return [[cores[(i * threads + j) % len(cores)] for j in range(threads)] for i in range(workers)]
+
+
+#######################
+# Worker process
+#######################
+
+def worker_main(conn, cores: List[int], prefix: str):
+    """Serve generations from one model over `conn` until the API closes it.
+
+    Requests are ('generate', prompt, stop) and ('prefix', text). A generation answers with
+    ('token', text) messages and ends with ('done', counters) or ('error', message), where
+    counters are the increments of `llama2.counters()`. A ('cancel',) received during a
+    generation stops it at the next token.
+    """
+    # Ctrl-C in the terminal reaches the whole process group; the API shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    client = llama2.load_model(threads=len(cores) or None).client
+    if prefix:
+        llama2.set_prompt_prefix(client, prefix)
+    conn.send(('ready',))
+
+    def cancelled() -> bool:
+        # Anything the API sends while a generation runs is a cancel
+        return conn.poll() and conn.recv()[0] == 'cancel'
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message[0] == 'prefix':
+            llama2.set_prompt_prefix(client, message[1])
+            conn.send(('done', {}))
+        elif message[0] == 'generate':
+            _, prompt, stop = message
+            before = {group: dict(values) for group, values in llama2.counters().items()}
+            try:
+                llama2.generate_tokens(client, prompt, stop, lambda token: conn.send(('token', token)), cancelled)
+            except Exception as e:
+                conn.send(('error', repr(e)))
+            else:
+                conn.send(('done', {group: {key: value - before[group][key] for key, value in values.items()}
+                                    for group, values in llama2.counters().items()}))
+            llama2._restore_prefix(client)
+        # a late ('cancel',) for a generation that already finished is dropped
+
+
+#######################
+# Pool, in the API process
+#######################
+
+class Worker:
+    def __init__(self, index: int, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+
+
+class LlamaWorkerPool:
+    """Local llama2 generations served by `workers` spawned processes.
+
+    Each worker holds its own copy of the model, pinned to its own cores (`core_sets`) with
+    one ctransformers thread per core, so generation does not compete with the event loop
+    and the embedding model for CPU. Tokens stream back over a pipe per worker. A request
+    takes an idle worker for the whole generation.
+
+    A worker that dies fails only the request it was serving. It is replaced in the
+    background, and the other workers keep serving meanwhile.
+    """
+
+    def __init__(self, workers: int, threads: Optional[int] = None):
+        self.cores = core_sets(workers, threads or int(os.environ.get('LLAMA2_WORKER_THREADS', 0)) or None)
+        self.prefix = ''
+        self.crashes = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._idle: queue.Queue = queue.Queue()
+        self._workers: List[Optional[Worker]] = [self._spawn(i) for i in range(workers)]
+        for worker in self._workers:
+            self._wait_ready(worker)
+
+    def _spawn(self, index: int) -> Worker:
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=worker_main, args=(child_conn, self.cores[index], self.prefix),
+                                        name=f'llama-{index}', daemon=True)
+        process.start()
+        child_conn.close()
+        return Worker(index, process, conn)
+
+    def _wait_ready(self, worker: Worker):
+        message = worker.conn.recv()
+        assert message == ('ready',), message
+        self._workers[worker.index] = worker
+        self._idle.put(worker)
+
+    def _replace(self, worker: Worker):
+        self.crashes += 1
+        self._workers[worker.index] = None
+        worker.conn.close()
+        worker.process.join(timeout=1)
+        print(f"Llama worker {worker.index} died (exit code {worker.process.exitcode}), restarting")
+
+        def restart():
+            while True:
+                try:
+                    self._wait_ready(self._spawn(worker.index))
+                    return
+                except (EOFError, OSError) as e:
+                    print(f"Llama worker {worker.index} failed to start: {e!r}")
+                    time.sleep(5)
+
+        threading.Thread(target=restart, name=f'llama-{worker.index}-restart', daemon=True).start()
+
+    def _acquire(self) -> Worker:
+        while True:
+            worker = self._idle.get()
+            if worker.process.is_alive():
+                return worker
+            self._replace(worker)
+
+    def generate(self, prompt: str, stop: Optional[List[str]], on_token, cancelled: threading.Event) -> str:
+        worker = self._acquire()
+        try:
+            worker.conn.send(('generate', prompt, stop))
+            text = []
+            cancel_sent = False
+            while True:
+                if cancelled.is_set() and not cancel_sent:
+                    worker.conn.send(('cancel',))
+                    cancel_sent = True
+                if not worker.conn.poll(0.1):
+                    continue
+                message = worker.conn.recv()
+                if message[0] == 'token':
+                    text.append(message[1])
+                    on_token(message[1])
+                elif message[0] == 'done':
+                    counters = llama2.counters()
+                    for group, values in message[1].items():
+                        for key, value in values.items():
+                            counters[group][key] += value
+                    return ''.join(text)
+                else:
+                    raise RuntimeError(f"Llama worker {worker.index}: {message[1]}")
+        except (EOFError, OSError) as e:
+            self._replace(worker)
+            worker = None
+            raise RuntimeError(f"Llama worker crashed during generation: {e!r}") from e
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+
+    def set_prefix(self, prefix: str):
+        """Evaluate `prefix` in every worker; replacement workers evaluate it on start."""
+        self.prefix = prefix
+        workers = [self._acquire() for _ in range(len(self._workers))]
+        try:
+            for worker in workers:
+                worker.conn.send(('prefix', prefix))
+            for worker in workers:
+                worker.conn.recv()
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+
+    def stats(self) -> dict:
+        return {
+            'workers': len(self._workers),
+            'alive': sum(1 for worker in self._workers if worker is not None and worker.process.is_alive()),
+            'idle': self._idle.qsize(),
+            'cores': self.cores,
+            'crashes': self.crashes,
+        }
+
+
+class PooledLlama(llama2.ThreadStreaming, LLM):
+    """LangChain LLM over a LlamaWorkerPool. Calls wait for a free worker on a thread of their own."""
+
+    pool: Any  #: :meta private:
+
+    @property
+    def _llm_type(self) -> str:
+        return 'llama2_workers'
+
+    def _executor(self) -> ThreadPoolExecutor:
+        return _pool_threads(len(self.pool.cores))
+
+    def _generate_tokens(self, prompt: str, stop: Optional[List[str]], on_token, cancelled: threading.Event) -> str:
+        return self.pool.generate(prompt, stop, on_token, cancelled)
+
+
+_threads = None
+
+def _pool_threads(workers: int) -> ThreadPoolExecutor:
+    global _threads
+    if _threads is None:
+        # One per worker and a few for calls waiting on a busy pool
+        _threads = ThreadPoolExecutor(max_workers=2 * workers, thread_name_prefix='llama-pool')
+    return _threads
@@ -0,0 +1,208 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Iterable, List, Optional, Tuple
+
+import jsonlines
+import numpy as np
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from llmodels.mmr import mmr_select
+
+VECTORS_FILE = 'vectors.npy'
+METADATA_FILE = 'metadata.jsonl'
+HNSW_FILE = 'hnsw.bin'
+MANIFEST_FILE = 'manifest.json'
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def build_local_index(
+    chunk_files: list[str],
+    output_dir: str,
+    embed_model: Embeddings,
+    text_field: str = 'text',
+    dtype: str = 'float32',
+    hnsw: bool = False,
+    batch_size: int = 256,
+):
+    """Build a local vector index from the chunk jsonl files written by `Crawler.write_chunk_text`.
+
+    The index directory contains
+    - vectors.npy: L2-normalized embeddings, one row per chunk, loaded with mmap
+    - metadata.jsonl: the Pinecone-style metadata of each row (text, source, title, chunk-id, updated)
+    - hnsw.bin: optional HNSW graph over the rows (requires `hnswlib`)
+    - manifest.json: dimension, dtype and row count
+
+    Parameters
+    ----------
+    chunk_files : list[str]
+        Paths to jsonl files with 'chunk', 'source', 'title', 'chunk-id' and 'updated' fields
+    output_dir : str
+        Directory to write the index to, created if missing
+    embed_model : Embeddings
+        The same embedding model that is used for queries
+    text_field : str, optional
+        Metadata field holding the chunk text, by default 'text'
+    dtype : str, optional
+        'float32', or 'float16' to halve the file size. float16 rows are converted to
+        float32 in memory on load, as NumPy has no fast float16 matrix product. By default
+        'float32'
+    hnsw : bool, optional
+        Also build an HNSW graph for approximate search, by default False
+    batch_size : int, optional
+        Number of chunks embedded per call, by default 256
+    """
+    metadata = []
+    for chunk_file in chunk_files:
+        with jsonlines.open(chunk_file, 'r') as f:
+            for entry in f:
+                metadata.append({
+                    text_field: entry['chunk'],
+                    'source': entry['source'],
+                    'title': entry.get('title'),
+                    'chunk-id': entry.get('chunk-id'),
+                    'updated': entry.get('updated'),
+                })
+
+    vectors = []
+    for i in range(0, len(metadata), batch_size):
+        texts = [m[text_field] for m in metadata[i:i + batch_size]]
+        vectors.append(np.asarray(embed_model.embed_documents(texts), dtype=np.float32))
+    matrix = _normalize_rows(np.concatenate(vectors)) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+    output_dir = Path(output_dir)
+    if not output_dir.exists():
+        os.makedirs(output_dir)
+
+    np.save(output_dir / VECTORS_FILE, matrix.astype(dtype))
+    with jsonlines.open(output_dir / METADATA_FILE, 'w') as f:
+        f.write_all(metadata)
+
+    if hnsw and len(metadata):
+        import hnswlib
+        graph = hnswlib.Index(space='ip', dim=matrix.shape[1])
+        graph.init_index(max_elements=matrix.shape[0], ef_construction=200, M=16)
+        graph.add_items(matrix, np.arange(matrix.shape[0]))
+        graph.save_index(str(output_dir / HNSW_FILE))
+
+    with open(output_dir / MANIFEST_FILE, 'w', encoding='utf-8') as f:
+        json.dump({
+            'count': int(matrix.shape[0]),
+            'dimension': int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+            'dtype': dtype,
+            'text_field': text_field,
+            'hnsw': bool(hnsw),
+        }, f)
+
+
+class LocalVectorStore(VectorStore):
+    """Read-only vector store over an index directory written by `build_local_index`.
+
+    Drop-in replacement for `Pinecone(index, embed_model, text_field)`: the embedding matrix is
+    memory-mapped, so startup only reads the metadata sidecar, and search is an exact dot
+    product over normalized vectors, or an HNSW lookup when the graph was built.
+    """
+
+    def __init__(self, vectors: np.ndarray, metadata: List[dict], embedding: Embeddings,
+                 text_key: str = 'text', hnsw=None):
+        """`vectors` are L2-normalized rows (an np.memmap when loaded from disk), `metadata`
+        holds one dict per row. Use `LocalVectorStore.load` to open an index directory."""
+        self.vectors = vectors
+        self.metadata = metadata
+        self._embedding = embedding
+        self._text_key = text_key
+        self._hnsw = hnsw
+
+    @classmethod
+    def load(cls, index_dir: str, embedding: Embeddings, text_key: str = 'text',
+             use_hnsw: bool = True, ef_search: int = 64) -> 'LocalVectorStore':
+        index_dir = Path(index_dir)
+        vectors = np.load(index_dir / VECTORS_FILE, mmap_mode='r')
+        if vectors.dtype != np.float32:
+            # float16 matrix products do not use BLAS and are ~20x slower than float32
+            vectors = vectors.astype(np.float32)
+        with jsonlines.open(index_dir / METADATA_FILE, 'r') as f:
+            metadata = list(f)
+        hnsw = None
+        if use_hnsw and (index_dir / HNSW_FILE).exists():
+            import hnswlib
+            hnsw = hnswlib.Index(space='ip', dim=vectors.shape[1])
+            hnsw.load_index(str(index_dir / HNSW_FILE), max_elements=vectors.shape[0])
+            hnsw.set_ef(ef_search)
+        return cls(vectors, metadata, embedding, text_key, hnsw)
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding
+
+    def __len__(self) -> int:
+        return len(self.metadata)
+
+    def _to_document(self, row: int) -> Document:
+        metadata = dict(self.metadata[row])
+        text = metadata.pop(self._text_key, '')
+        return Document(page_content=text, metadata=metadata)
+
+    def search_rows(self, embedding: List[float], k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the row ids and cosine scores of the `k` nearest rows, best first."""
+        k = min(k, len(self.metadata))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        if self._hnsw is not None:
+            labels, distances = self._hnsw.knn_query(query, k=k)
+            return labels[0].astype(np.int64), 1 - distances[0]
+        scores = self.vectors @ query
+        rows = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        rows = rows[np.argsort(-scores[rows])]
+        return rows, scores[rows].astype(np.float32)
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        rows, scores = self.search_rows(embedding, k)
+        return [(self._to_document(row), float(score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self._embedding.embed_query(query), k)
+
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+    def max_marginal_relevance_search_by_vector(self, embedding: List[float], k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, **kwargs: Any) -> List[Document]:
+        rows, _ = self.search_rows(embedding, fetch_k)
+        query = np.asarray(embedding, dtype=np.float32)
+        selected = mmr_select(query / (np.linalg.norm(query) or 1),
+                              np.asarray(self.vectors[rows], dtype=np.float32),
+                              k=k, lambda_mult=lambda_mult)
+        return [self._to_document(rows[i]) for i in selected]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20,
+                                      lambda_mult: float = 0.5, **kwargs: Any) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(self._embedding.embed_query(query),
+                                                            k, fetch_k, lambda_mult)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        raise ValueError("LocalVectorStore is read-only: add the chunks to the chunk files and rebuild the "
+                         "index with local_index_build.py (build_local_index)")
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   index_dir: str = 'local_index', **kwargs: Any) -> 'LocalVectorStore':
+        raise ValueError("LocalVectorStore is read-only and cannot be created from texts: build the index "
+                         "from chunk files with local_index_build.py (build_local_index), then "
+                         "LocalVectorStore.load it")
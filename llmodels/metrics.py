@@ -0,0 +1,197 @@
+"""Prometheus metrics for the /q pipeline.
+
+Every request gets a `RequestTimer`. It is passed to the chain as a callback, so it sees the
+retriever, combine-docs and LLM runs, and it is made the current timer (a context variable)
+for code that LangChain does not report on, like the embedding and vector search inside the
+retriever. Stage durations go to one histogram, labelled by LLM backend and stage:
+
+    queue            admission wait
+    rewrite          local follow-up detection and rewriting
+    embed            query embedding (batched / cached), once per request: the retriever's
+                     lookup of a vector already embedded for the semantic cache is not counted
+    cache_lookup     semantic answer cache lookup
+    search           vector search + MMR (+ waiting for the keyword search)
+    keyword_search   BM25 search, in parallel with embed and search
+    rerank           cross-encoder rerank, bounded by its deadline
+    pack             merging overlapping chunks and packing them under the token budget
+    retrieve         whole retriever run, embed + search
+    condense_question  follow-up question rewriting, only with chat history
+    combine_docs     stuffing the retrieved chunks into the prompt, up to the LLM call
+    first_token      request start -> first answer token
+    generate         first answer token -> last answer token
+    last_token       request start -> last answer token
+    first_frame      request start -> first frame written to the response
+    total            request start -> end frame written
+
+Chain failures are counted by exception type. Gauges of the admission controller (`track_admission`) show the /q requests holding a slot
+and those waiting for one.
+
+With several worker processes set PROMETHEUS_MULTIPROC_DIR to an empty directory before
+starting the server, so /metrics aggregates all workers.
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import AsyncCallbackHandler
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest)
+
+from llmodels.streaming import is_combine_docs_chain
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_SECONDS = Histogram('rag_stage_seconds', 'Duration of each stage of a /q request',
+                          ['backend', 'stage'], buckets=BUCKETS)
+REQUESTS = Counter('rag_requests_total', '/q requests by outcome', ['backend', 'outcome'])
+TOKENS = Counter('rag_answer_tokens_total', 'Answer tokens streamed to clients', ['backend'])
+FRAMES = Counter('rag_frames_sent_total', 'Response frames written', ['backend'])
+FRAME_BYTES = Counter('rag_frame_bytes_sent_total', 'Response bytes written', ['backend'])
+ERRORS = Counter('rag_chain_errors_total', 'Chain runs that raised, by exception type', ['backend', 'error'])
+REWRITES = Counter('rag_question_rewrites_total', 'Questions by rewrite path: standalone, local or llm',
+                   ['backend', 'path'])
+# Summed over the live worker processes with PROMETHEUS_MULTIPROC_DIR
+IN_FLIGHT = Gauge('rag_admission_in_flight', '/q requests holding an admission slot', ['backend'],
+                  multiprocess_mode='livesum')
+QUEUE_DEPTH = Gauge('rag_admission_queue_depth', '/q requests waiting for an admission slot', ['backend'],
+                    multiprocess_mode='livesum')
+
+_current_timer: contextvars.ContextVar[Optional['RequestTimer']] = contextvars.ContextVar('request_timer',
+                                                                                            default=None)
+
+
+class RequestTimer(AsyncCallbackHandler):
+    """Stage timings of one request. Also a chain callback, see the module docstring."""
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self.start = time.perf_counter()
+        self.outcome = None
+        self.first_frame_sent = False
+        self._combine_start = None
+        self._answer_run = None
+        self._first_token = None
+        self._condense_runs: Dict[UUID, float] = {}
+        self._retriever_runs: Dict[UUID, float] = {}
+        self.stages = set()     # stages observed so far
+
+    def activate(self):
+        """Make this the timer seen by `timed()` in this task and the tasks it creates."""
+        _current_timer.set(self)
+
+    def observe(self, stage: str, seconds: float):
+        self.stages.add(stage)
+        STAGE_SECONDS.labels(self.backend, stage).observe(seconds)
+
+    def mark(self, stage: str):
+        """Record the time from the start of the request until now."""
+        self.observe(stage, time.perf_counter() - self.start)
+
+    def frame_sent(self, frame: str):
+        if not self.first_frame_sent:
+            self.first_frame_sent = True
+            self.mark('first_frame')
+        FRAMES.labels(self.backend).inc()
+        FRAME_BYTES.labels(self.backend).inc(len(frame.encode('utf-8')))
+
+    def rewrite(self, path: str):
+        REWRITES.labels(self.backend, path).inc()
+
+    def error(self, error: BaseException):
+        """Record a failed chain run; the request ends with outcome 'error'."""
+        self.outcome = 'error'
+        ERRORS.labels(self.backend, type(error).__name__).inc()
+
+    def finish(self, outcome: str):
+        self.mark('total')
+        REQUESTS.labels(self.backend, outcome).inc()
+
+    #######################
+    # Chain callbacks
+    #######################
+
+    async def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any):
+        if is_combine_docs_chain(serialized):
+            self._combine_start = time.perf_counter()
+
+    async def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID, **kwargs: Any):
+        self._retriever_runs[run_id] = time.perf_counter()
+
+    async def on_retriever_end(self, documents, *, run_id: UUID, **kwargs: Any):
+        start = self._retriever_runs.pop(run_id, None)
+        if start is not None:
+            self.observe('retrieve', time.perf_counter() - start)
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any):
+        now = time.perf_counter()
+        if self._combine_start is not None:
+            # The LLM call made by the combine-docs chain produces the answer
+            self.observe('combine_docs', now - self._combine_start)
+            self._combine_start = None
+            self._answer_run = run_id
+        else:
+            self._condense_runs[run_id] = now
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        if run_id != self._answer_run:
+            return
+        if self._first_token is None:
+            self._first_token = time.perf_counter()
+            self.mark('first_token')
+        TOKENS.labels(self.backend).inc()
+
+    async def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        now = time.perf_counter()
+        if run_id == self._answer_run:
+            self.mark('last_token')
+            if self._first_token is not None:
+                self.observe('generate', now - self._first_token)
+        elif run_id in self._condense_runs:
+            self.observe('condense_question', now - self._condense_runs.pop(run_id))
+
+
+def current_timer() -> Optional[RequestTimer]:
+    return _current_timer.get()
+
+
+@contextmanager
+def timed(stage: str, once: bool = False):
+    """Time the block as `stage` of the current request; a no-op outside of a request.
+
+    With `once`, the block is not timed if the request already has a `stage` sample.
+    """
+    timer = _current_timer.get()
+    if timer is None or once and stage in timer.stages:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.observe(stage, time.perf_counter() - start)
+
+
+def track_admission(backend: str, controller):
+    """Keep the admission gauges of `backend` up to date with an AdmissionController."""
+    in_flight, queue_depth = IN_FLIGHT.labels(backend), QUEUE_DEPTH.labels(backend)
+
+    def changed():
+        in_flight.set(controller.active)
+        queue_depth.set(controller.queue_depth)
+
+    controller.on_change = changed
+    changed()
+
+
+def render() -> tuple[bytes, str]:
+    """Exposition for GET /metrics: (body, content type)."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
@@ -0,0 +1,37 @@
+from typing import List
+
+import numpy as np
+
+
+def mmr_select(query: np.ndarray, candidates: np.ndarray, k: int = 4, lambda_mult: float = 0.5) -> List[int]:
+    """Maximal marginal relevance over pre-normalized vectors.
+
+    `query` has shape (d,) and `candidates` (n, d), both L2-normalized, so dot products are
+    cosine similarities. The best redundancy score of every candidate is updated with one
+    matrix-vector product per selected item instead of recomputing the full similarity
+    matrix and looping over candidates in Python.
+    """
+    n = candidates.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return []
+    similarity_to_query = candidates @ query
+    max_similarity_to_selected = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    selected = [int(np.argmax(similarity_to_query))]
+    available[selected[0]] = False
+    while len(selected) < k:
+        np.maximum(max_similarity_to_selected, candidates @ candidates[selected[-1]],
+                   out=max_similarity_to_selected)
+        scores = lambda_mult * similarity_to_query - (1 - lambda_mult) * max_similarity_to_selected
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+    return selected
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
@@ -0,0 +1,38 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class ChainPool:
+    """Pool of long-lived chain instances shared between requests.
+
+    Chains are built lazily by `factory` up to `size` instances and handed out one request
+    at a time. `factory` runs on a worker thread, as it may load models on first use. Nothing request-specific is stored on a chain: streaming callbacks are passed
+    to `arun(..., callbacks=[...])` so each request gets its own tokens.
+    """
+
+    def __init__(self, factory, size: int = 1):
+        self._factory = factory
+        self.size = max(1, size)
+        self._idle = asyncio.Queue()
+        self._created = 0
+
+    @property
+    def in_use(self) -> int:
+        return self._created - self._idle.qsize()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Borrow a chain for the duration of the `async with` block."""
+        if self._idle.empty() and self._created < self.size:
+            self._created += 1
+            try:
+                chain = await asyncio.to_thread(self._factory)
+            except Exception:
+                self._created -= 1
+                raise
+        else:
+            chain = await self._idle.get()
+        try:
+            yield chain
+        finally:
+            self._idle.put_nowait(chain)
@@ -1,29 +1,51 @@
 from langchain.llms import OpenAI
 import os
 import json
+import importlib
+import logging
 from dotenv import load_dotenv
 load_dotenv()
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+#######################
+# Components are loaded lazily on first use, or all at once in parallel by warmup(),
+# so importing this module (and binding the server socket) is fast.
+#######################
+
+from llmodels.lazy import Lazy
+
+logger = logging.getLogger(__name__)
+
 #######################
 # Step 1: Initializing the LLM Model (GPT-3)   
 #######################
 
-from llmodels.gpt3 import build_llm
-#from llmodels.llama2 import build_llm
-print("LLM: ready")
+# LLM_BACKEND selects the module in llmodels/ providing build_llm: 'gpt3', 'llama2' or 'fake'
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'gpt3')
+llm_backend = importlib.import_module(f'llmodels.{LLM_BACKEND}')
+build_llm = llm_backend.build_llm
+get_llm = Lazy(build_llm, "LLM")
+
 #######################
 # Step 2: Building the Knowledge Base
 #######################
 
-import pinecone
-pinecone.init(  
-    api_key=os.environ.get('PINECONE_API_KEY'),
-    environment=os.environ.get('PINECONE_ENV')
-)
+# VECTOR_BACKEND selects where chunks are retrieved from:
+# 'pinecone' (hosted index), 'local' (memory-mapped index built by local_index_build.py)
+# or 'fake' (synthetic in-memory corpus for offline benchmarks)
+VECTOR_BACKEND = os.environ.get('VECTOR_BACKEND', 'pinecone')
+LOCAL_INDEX_DIR = os.environ.get('LOCAL_INDEX_DIR', 'local_index')
 index_name = 'duhocsinh-se'
-index = pinecone.Index(index_name)
-print("Pinecone DB: ready")
+
+def init_pinecone_index():
+    import pinecone
+    pinecone.init(  
+        api_key=os.environ.get('PINECONE_API_KEY'),
+        environment=os.environ.get('PINECONE_ENV')
+    )
+    return pinecone.Index(index_name)
+
+get_index = Lazy(init_pinecone_index, "Pinecone DB")
 
 #######################
 # Step 3: Initializing the Embedding Pipeline (Hugging Face Sentence Transformer)
@@ -32,30 +54,61 @@ print("Pinecone DB: ready")
 # and can be used for tasks like clustering or semantic search.
 #######################
 
-from langchain.embeddings.huggingface import HuggingFaceEmbeddings
-embed_model_id = 'sentence-transformers/all-MiniLM-L6-v2'
+# EMBED_MODEL_ID=fake selects hashed stand-in embeddings for offline benchmarks
+embed_model_id = os.environ.get('EMBED_MODEL_ID', 'sentence-transformers/all-MiniLM-L6-v2')
 device = 'cpu'
-embed_model = HuggingFaceEmbeddings(
-    model_name=embed_model_id,
-    model_kwargs={'device': device},
-    encode_kwargs={'device': device, 'batch_size': 32}
-)
-print("Embed model: ready")
+
+def load_embed_model():
+    if embed_model_id == 'fake':
+        from llmodels.fake import FakeEmbeddings
+        return FakeEmbeddings()
+    from langchain.embeddings.huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(
+        model_name=embed_model_id,
+        model_kwargs={'device': device},
+        encode_kwargs={'device': device, 'batch_size': 32}
+    )
+
+get_embed_model = Lazy(load_embed_model, "Embed model")
+
+# Query-side front-end: LRU cache + micro-batching of concurrent queries, encoded off the event loop
+from llmodels.embedding import EmbeddingService
+embedder = EmbeddingService(get_embed_model,
+                            cache_size=int(os.environ.get('EMBED_CACHE_SIZE', 4096)),
+                            max_batch=int(os.environ.get('EMBED_MAX_BATCH', 32)),
+                            max_wait_ms=float(os.environ.get('EMBED_MAX_WAIT_MS', 3)))
 
 #######################
 # Step 4: Initializing the RetrievalQA Component
 # Langchain to glue the components together  
 #######################
 
-from langchain.vectorstores import Pinecone
 from langchain.chains import ConversationalRetrievalChain
 from langchain.prompts import PromptTemplate
+from llmodels.pool import ChainPool
+from llmodels.admission import AdmissionController
+from llmodels.cache import SemanticCache
+from llmodels.retriever import MMRRetriever
+from llmodels.context import ContextPacker
 
 
 text_field = 'text'  # field in metadata that contains text content                              
-vectorstore = Pinecone(index,
-                       embed_model,
-                       text_field)
+
+def build_vectorstore():
+    if VECTOR_BACKEND == 'fake':
+        from llmodels.fake import build_vectorstore as build_fake_vectorstore
+        return build_fake_vectorstore(embedder, text_field)
+    if VECTOR_BACKEND == 'local':
+        from llmodels.local_index import LocalVectorStore
+        return LocalVectorStore.load(LOCAL_INDEX_DIR,
+                                     embedder,
+                                     text_field)
+    from langchain.vectorstores import Pinecone
+    return Pinecone(get_index(),
+                    embedder,
+                    text_field)
+
+get_vectorstore = Lazy(build_vectorstore, "Vector store")
 
 prompt_template = """Answer ONLY with the facts listed in the list of sources below. If there isn't enough information below, say you don't know. Do not generate answers that don't use the sources below. For tabular information return it as an html table. Do not return markdown format. If the question is not in English, answer in the language used in the question. For every fact in your answer, cite the source by including its URL inside square brackets. Do not include a source list.
 
@@ -139,20 +192,300 @@ def build_prompt(messages):
                 break
             chat_history.insert(0, (formatted_question, formatted_response))
             num_char_in_chat_history += len(formatted_question) + len(formatted_response)
-    #return {"question": messages[-1]['content'], "chat_history": chat_history}
-    return {"question": messages[-1]['content'], "chat_history": []}
+    return {"question": messages[-1]['content'], "chat_history": chat_history}
+
+
+# Retrieved chunks are deduplicated (adjacent chunks overlap by 200 characters) and packed
+# under a token budget counted with the LLM's tokenizer. Set {BACKEND}_CONTEXT_TOKENS=0 to
+# stuff the chunks verbatim.
+context_tokens = int(os.environ.get(f'{LLM_BACKEND.upper()}_CONTEXT_TOKENS', llm_backend.CONTEXT_TOKENS))
+context_packer = ContextPacker(llm_backend.count_tokens, max_tokens=context_tokens) if context_tokens > 0 else None
+
+# Hybrid search: a BM25 index built by bm25_index_build.py is queried alongside the vectors and
+# the rankings are fused. On by default when the index file exists; HYBRID_SEARCH=0 disables it.
+# Exact-term matches make the top results more precise, so fewer chunks are sent to the LLM.
+BM25_INDEX = os.environ.get('BM25_INDEX', os.path.join(LOCAL_INDEX_DIR, 'bm25.sqlite'))
+hybrid_search = os.environ.get('HYBRID_SEARCH', '1' if os.path.exists(BM25_INDEX) else '0') == '1'
 
+# Optional cross-encoder rerank of the best RERANK_CANDIDATES candidates (RERANK=1). If it does
+# not finish within RERANK_DEADLINE_MS the retrieval order is used.
+RERANK = os.environ.get('RERANK', '0') == '1'
+rerank_model_id = os.environ.get('RERANK_MODEL_ID', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
 
-def get_generate_text(stream_callback):
-    llm = build_llm(stream_callback)
+def load_rerank_model():
+    if rerank_model_id == 'fake':
+        from llmodels.fake import FakeCrossEncoder
+        return FakeCrossEncoder()
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(rerank_model_id, max_length=512, device=device)
+
+get_rerank_model = Lazy(load_rerank_model, "Rerank model")
+
+from llmodels.rerank import Reranker
+reranker = Reranker(get_rerank_model,
+                    candidates=int(os.environ.get('RERANK_CANDIDATES', 12)),
+                    deadline_ms=float(os.environ.get('RERANK_DEADLINE_MS', 150))) if RERANK else None
+
+def build_retriever():
+    from llmodels.bm25 import BM25Index
+    return MMRRetriever(vectorstore=get_vectorstore(),
+                        embeddings=embedder,
+                        k=int(os.environ.get('RETRIEVER_K', 3 if hybrid_search or RERANK else 4)),
+                        fetch_k=int(os.environ.get('RETRIEVER_FETCH_K', 20)),
+                        lambda_mult=float(os.environ.get('RETRIEVER_MMR_LAMBDA', 0.5)),
+                        # The synthetic fake corpus shares only a few words with any question, so its
+                        # hashed bag-of-words similarities fall below a threshold meant for real embeddings
+                        score_threshold=float(os.environ.get('RETRIEVER_SCORE_THRESHOLD',
+                                                             0.0 if VECTOR_BACKEND == 'fake' else 0.3)),
+                        keyword_index=BM25Index(BM25_INDEX, text_key=text_field) if hybrid_search else None,
+                        reranker=reranker,
+                        packer=context_packer)
+
+get_retriever = Lazy(build_retriever, "Retriever")
+
+def get_generate_text(stream_callback=None):
+    llm = build_llm(stream_callback) if stream_callback is not None else get_llm()
     generate_text = ConversationalRetrievalChain.from_llm(llm=llm,
-                                                        retriever=vectorstore.as_retriever(
-                                                            search_kwargs={"k": 4},
-                                                            search_type="mmr",
-                                                            score_threshold=0.3),
+                                                        retriever=get_retriever(),
                                                         combine_docs_chain_kwargs={
                                                             'prompt': QA_PROMPT,
                                                             'document_prompt': document_prompt
                                                         },
                                                         return_source_documents=False)
     return generate_text
+
+#######################
+# Admission control and chain pool
+# Admission bounds concurrent /q streams per backend; excess requests queue briefly, then get 429/503.
+# Chains are built once and reused; pass the request's stream callback with
+# `generate_text.arun(prompt, callbacks=[stream_callback])`.
+# The pool holds at least one chain per admitted request, so an admitted request never waits
+# again in the pool's unbounded queue: admission is the only queue.
+#######################
+
+max_concurrency = int(os.environ.get(f'{LLM_BACKEND.upper()}_MAX_CONCURRENCY', llm_backend.MAX_CONCURRENCY))
+
+chain_pool = ChainPool(get_generate_text,
+                       size=int(os.environ.get('CHAIN_POOL_SIZE', max(llm_backend.POOL_SIZE, max_concurrency))))
+
+admission = AdmissionController(
+    max_concurrency=max_concurrency,
+    max_queue=int(os.environ.get(f'{LLM_BACKEND.upper()}_MAX_QUEUE', llm_backend.MAX_QUEUE)),
+    queue_timeout=float(os.environ.get(f'{LLM_BACKEND.upper()}_QUEUE_TIMEOUT', llm_backend.QUEUE_TIMEOUT)))
+
+#######################
+# Request deadline
+# Every /q request gets a Deadline that retrieval and generation respect; they degrade
+# (fewer chunks, shorter answers) before it runs out. See llmodels/deadline.py.
+#######################
+
+from llmodels.deadline import Deadline
+
+request_deadline_seconds = float(os.environ.get(f'{LLM_BACKEND.upper()}_REQUEST_DEADLINE', llm_backend.REQUEST_DEADLINE))
+tokens_per_second = float(os.environ.get(f'{LLM_BACKEND.upper()}_TOKENS_PER_SECOND', llm_backend.TOKENS_PER_SECOND))
+first_token_seconds = float(os.environ.get(f'{LLM_BACKEND.upper()}_FIRST_TOKEN_SECONDS', llm_backend.FIRST_TOKEN_SECONDS))
+# Retrieval leaves enough time to generate an answer of at least this many tokens
+deadline_answer_tokens = int(os.environ.get('DEADLINE_ANSWER_TOKENS', 64))
+
+def request_deadline(seconds: float = None) -> Deadline:
+    """Deadline of a request arriving now; a client's `seconds` is capped at the backend's."""
+    shortened = bool(seconds) and seconds < request_deadline_seconds
+    seconds = min(seconds, request_deadline_seconds) if seconds else request_deadline_seconds
+    return Deadline(seconds,
+                    shortened=shortened,
+                    reserve=first_token_seconds + deadline_answer_tokens / tokens_per_second,
+                    tokens_per_second=tokens_per_second,
+                    first_token_seconds=first_token_seconds)
+
+#######################
+# Semantic answer cache
+# Paraphrases of an answered question are replayed from memory instead of
+# going through Pinecone and the LLM. Set SEMANTIC_CACHE_SIZE=0 to disable.
+#######################
+
+semantic_cache = SemanticCache(threshold=float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.92)),
+                               ttl=float(os.environ.get('SEMANTIC_CACHE_TTL', 3600)),
+                               max_entries=int(os.environ.get('SEMANTIC_CACHE_SIZE', 1024)))
+
+#######################
+# Conversation sessions
+# Clients send only the new message plus the `session_state` token of the previous answer.
+# Recent turns are kept up to SESSION_HISTORY_TOKENS, older ones summarized in the background.
+#######################
+
+from llmodels.sessions import SessionStore, extractive_summarizer, llm_summarizer
+
+session_history_tokens = int(os.environ.get('SESSION_HISTORY_TOKENS', 512))
+sessions = SessionStore(llm_backend.count_tokens,
+                        llm_summarizer(get_llm) if llm_backend.SUMMARIZE_HISTORY
+                        else extractive_summarizer(llm_backend.count_tokens, session_history_tokens // 2),
+                        history_tokens=session_history_tokens,
+                        max_sessions=int(os.environ.get('SESSION_MAX', 10000)),
+                        idle_ttl=float(os.environ.get('SESSION_IDLE_TTL', 1800)))
+
+#######################
+# Query rewriting
+# Follow-ups are made standalone locally where possible, so the chain skips its
+# condense-question LLM call. QUERY_REWRITE: 'auto', 'local' (never the LLM) or 'llm' (always).
+#######################
+
+from llmodels.rewriter import QueryRewriter
+rewriter = QueryRewriter(mode=os.environ.get('QUERY_REWRITE', 'auto'))
+
+#######################
+# Batch answering
+# For evaluations and pre-generating FAQ answers. The questions are embedded in one batch and
+# searched concurrently; answers are generated BATCH_CONCURRENCY at a time, each holding an
+# admission slot like a /q request, so /q keeps its share of the backend. Answers are stored
+# in the semantic cache.
+#######################
+
+import asyncio
+import time
+from llmodels.admission import AdmissionRejected
+from llmodels.embedding import normalize_query
+from llmodels.streaming import Sources
+
+batch_concurrency = int(os.environ.get('BATCH_CONCURRENCY', max(1, llm_backend.MAX_CONCURRENCY // 2)))
+
+async def admit_batch():
+    """An admission ticket for one batch generation; waits out rejections instead of failing."""
+    while True:
+        try:
+            return await admission.acquire()
+        except AdmissionRejected as e:
+            await asyncio.sleep(e.retry_after)
+
+async def answer_batch(questions: list, concurrency: int = None):
+    """Answer standalone `questions`, yielding a result per question as soon as it is done.
+
+    Results come in completion order; `index` is the question's position in `questions`.
+    Questions that are the same after normalization are answered once and reported at each
+    position. A question that fails gets an `error` instead of an answer, the others carry on.
+    """
+    positions = {}
+    for index, question in enumerate(questions):
+        positions.setdefault(normalize_query(question), []).append(index)
+    retriever = get_retriever()
+    vectors = await embedder.aembed_queries([questions[indexes[0]] for indexes in positions.values()])
+    generating = asyncio.Semaphore(concurrency or batch_concurrency)
+
+    async def answer(key: str, question: str, vector: list):
+        start = time.monotonic()
+        result = {}
+        try:
+            cached = semantic_cache.lookup(vector)
+            if cached is not None:
+                result.update(answer=''.join(cached.tokens), sources=cached.sources or [], cached=True)
+            else:
+                documents = await asyncio.to_thread(retriever.select, vector, question)
+                async with generating:
+                    ticket = await admit_batch()
+                    try:
+                        async with chain_pool.acquire() as generate_text:
+                            text = await generate_text.combine_docs_chain.arun(input_documents=documents,
+                                                                               question=question)
+                    finally:
+                        ticket.release()
+                sources = Sources.from_documents(documents)
+                semantic_cache.store(vector, question, [text], sources)
+                result.update(answer=text, sources=sources, cached=False)
+        except Exception as e:
+            result['error'] = repr(e)
+        result['seconds'] = round(time.monotonic() - start, 3)
+        return key, result
+
+    tasks = [asyncio.ensure_future(answer(key, questions[indexes[0]], vector))
+             for (key, indexes), vector in zip(positions.items(), vectors)]
+    try:
+        for done in asyncio.as_completed(tasks):
+            key, result = await done
+            for index in positions[key]:
+                yield {'index': index, 'question': questions[index], **result}
+    finally:
+        # The consumer went away (client disconnected): stop the remaining questions
+        for task in tasks:
+            task.cancel()
+
+#######################
+# Warmup
+# Loads every component in parallel, then runs a dummy embedding and retrieval so the
+# first real request does not pay for model loading or cold connections.
+#######################
+
+from concurrent.futures import ThreadPoolExecutor
+
+# A failed warmup (Pinecone unreachable, model download interrupted) is retried with
+# exponential backoff; a component that loaded is kept, only the failed ones load again.
+# After WARMUP_ATTEMPTS failures the worker gives up and /healthz fails, so it is restarted.
+WARMUP_ATTEMPTS = int(os.environ.get('WARMUP_ATTEMPTS', 5))
+WARMUP_BACKOFF = float(os.environ.get('WARMUP_BACKOFF', 2))
+
+warmup_state = {'ready': False, 'failed': False, 'error': None, 'attempts': 0, 'seconds': None}
+
+def components():
+    loaders = [get_llm, get_embed_model, get_vectorstore, get_retriever]
+    if VECTOR_BACKEND == 'pinecone':
+        loaders.insert(1, get_index)
+    if RERANK:
+        loaders.insert(-2, get_rerank_model)
+    return loaders
+
+def _warmup_once():
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix='warmup') as executor:
+        loads = [executor.submit(get_llm), executor.submit(get_embed_model)]
+        if VECTOR_BACKEND == 'pinecone':
+            loads.append(executor.submit(get_index))
+        if RERANK:
+            loads.append(executor.submit(get_rerank_model))
+        # Token counting loads its tokenizer on first use; do it here, not on the event loop
+        loads.append(executor.submit(llm_backend.count_tokens, "warmup"))
+        for load in loads:
+            load.result()
+    if hasattr(llm_backend, 'cache_prompt_prefix'):
+        # Local models keep the fixed instructions before the context evaluated
+        llm_backend.cache_prompt_prefix(prompt_template.split('{context}')[0])
+    get_retriever().get_relevant_documents("How much does it cost to study a Master's program in Sweden?")
+
+def warmup():
+    import time
+    start = time.monotonic()
+    for attempt in range(1, WARMUP_ATTEMPTS + 1):
+        warmup_state['attempts'] = attempt
+        try:
+            _warmup_once()
+            break
+        except Exception as e:
+            warmup_state['error'] = repr(e)
+            if attempt == WARMUP_ATTEMPTS:
+                warmup_state['failed'] = True
+                logger.exception("Warmup failed after %d attempts", attempt)
+                raise
+            delay = WARMUP_BACKOFF * 2 ** (attempt - 1)
+            logger.warning("Warmup attempt %d failed (%r), retrying in %.1fs", attempt, e, delay)
+            time.sleep(delay)
+    warmup_state['error'] = None
+    warmup_state['seconds'] = time.monotonic() - start
+    warmup_state['ready'] = True
+    logger.info("Warmup: done (%.1fs)", warmup_state['seconds'])
+
+def readiness() -> dict:
+    return {
+        **warmup_state,
+        'components': {loader.name: loader.ready for loader in components()},
+    }
+
+def preload():
+    """Load model weights without running them, in a parent process about to fork workers.
+
+    The forked workers share these pages copy-on-write. No inference is run here because
+    torch/OpenMP thread pools started before fork() are not usable in the children, and
+    network clients (Pinecone, OpenAI) are left for each worker to create.
+    """
+    get_embed_model()
+    if RERANK:
+        get_rerank_model()
+    if getattr(llm_backend, 'LOCAL_WEIGHTS', False):
+        get_llm()
+    if VECTOR_BACKEND in ('local', 'fake'):
+        get_vectorstore()
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import List, Tuple
+
+from langchain.schema import Document
+
+from llmodels.bm25 import doc_key
+from llmodels.embedding import normalize_query
+from llmodels.metrics import current_timer
+
+
+class Reranker:
+    """Cross-encoder rerank of the retrieved candidates, under a deadline.
+
+    All (query, chunk) pairs without a cached score are scored by the model in one
+    `predict` batch on a dedicated thread. Scores are cached by (query hash, `doc_key`), where
+    `doc_key` tells the chunks of a page apart by their text, so a repeated or
+    paraphrase-normalized question is reranked for free. If the
+    batch is not done within `deadline_ms`, the candidates are returned in their retrieval
+    order; the batch still finishes in the background and fills the cache. When
+    `max_pending` batches are already queued (the model cannot keep up), requests skip the
+    rerank instead of queueing behind them.
+
+    `model` is anything with `predict(pairs) -> scores` (sentence_transformers.CrossEncoder),
+    or a callable returning one on first use.
+    """
+
+    def __init__(self, model, candidates: int = 12, deadline_ms: float = 150, cache_size: int = 20000,
+                 max_pending: int = 4):
+        self._model = model
+        self.candidates = candidates
+        self.deadline = deadline_ms / 1000
+        self.cache_size = cache_size
+        self.max_pending = max_pending
+        self.reranked = 0
+        self.timeouts = 0
+        self.skipped = 0
+        self._pending = 0
+        self.pairs_scored = 0
+        self.pairs_cached = 0
+        self._cache: OrderedDict[tuple, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rerank')
+
+    @property
+    def model(self):
+        return self._model() if callable(self._model) else self._model
+
+    def _keys(self, query: str, documents: List[Document]) -> List[tuple]:
+        query_hash = hashlib.blake2b(normalize_query(query).encode('utf-8'), digest_size=8).digest()
+        return [(query_hash, *doc_key(document)) for document in documents]
+
+    def _score(self, query: str, documents: List[Document], keys: List[tuple]) -> List[float]:
+        try:
+            return self._score_batch(query, documents, keys)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _score_batch(self, query: str, documents: List[Document], keys: List[tuple]) -> List[float]:
+        with self._lock:
+            scores = [self._cache.get(key) for key in keys]
+            for key, score in zip(keys, scores):
+                if score is not None:
+                    self._cache.move_to_end(key)
+        missing = [i for i, score in enumerate(scores) if score is None]
+        self.pairs_cached += len(documents) - len(missing)
+        if missing:
+            predicted = self.model.predict([(query, documents[i].page_content) for i in missing])
+            self.pairs_scored += len(missing)
+            with self._lock:
+                for i, score in zip(missing, predicted):
+                    scores[i] = float(score)
+                    self._cache[keys[i]] = scores[i]
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return scores
+
+    @staticmethod
+    def _order(documents: List[Document], scores: List[float]) -> List[Document]:
+        order = sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)
+        return [documents[i] for i in order]
+
+    def _candidates(self, query: str, documents: List[Document]) -> Tuple[List[Document], List[tuple]]:
+        documents = documents[:self.candidates]
+        return documents, self._keys(query, documents)
+
+    def _admit(self) -> bool:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.skipped += 1
+                return False
+            self._pending += 1
+            return True
+
+    def rerank(self, query: str, documents: List[Document]) -> List[Document]:
+        """Candidates best first by cross-encoder score, or in retrieval order after the deadline."""
+        documents, keys = self._candidates(query, documents)
+        if not documents or not self._admit():
+            return documents
+        future = self._executor.submit(self._score, query, documents, keys)
+        try:
+            scores = future.result(timeout=self.deadline)
+        except FutureTimeout:
+            self.timeouts += 1
+            return documents
+        except Exception as e:
+            logger.exception("Rerank failed")
+            timer = current_timer()
+            if timer is not None:
+                timer.error(e)
+            return documents
+        self.reranked += 1
+        return self._order(documents, scores)
+
+    async def arerank(self, query: str, documents: List[Document], max_seconds: float = None) -> List[Document]:
+        """`rerank` without blocking the loop; `max_seconds` shortens the deadline for this call."""
+        documents, keys = self._candidates(query, documents)
+        if not documents or not self._admit():
+            return documents
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._score, query, documents, keys)
+        try:
+            # shield: on timeout the batch keeps running and caches its scores
+            scores = await asyncio.wait_for(asyncio.shield(future), min(self.deadline, max_seconds or self.deadline))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return documents
+        except Exception as e:
+            logger.exception("Rerank failed")
+            timer = current_timer()
+            if timer is not None:
+                timer.error(e)
+            return documents
+        self.reranked += 1
+        return self._order(documents, scores)
+
+    def stats(self) -> dict:
+        pairs = self.pairs_scored + self.pairs_cached
+        return {
+            'reranked': self.reranked,
+            'deadline_fallbacks': self.timeouts,
+            'skipped_overloaded': self.skipped,
+            'pairs_scored': self.pairs_scored,
+            'pair_cache_hit_rate': self.pairs_cached / pairs if pairs else 0.0,
+        }
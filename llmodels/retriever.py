@@ -0,0 +1,147 @@
+import asyncio
+from typing import List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+from langchain.schema.embeddings import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from llmodels.bm25 import BM25Index, reciprocal_rank_fusion
+from llmodels.context import ContextPacker
+from llmodels.deadline import DeadlineExceeded, bounded, current_deadline
+from llmodels.local_index import LocalVectorStore
+from llmodels.metrics import timed
+from llmodels.mmr import mmr_select, normalize
+from llmodels.rerank import Reranker
+
+
+def fetch_candidates(vectorstore: VectorStore, embedding: List[float], fetch_k: int):
+    """Fetch the `fetch_k` nearest chunks together with their vectors.
+
+    Returns (documents, cosine scores, normalized candidate matrix), best match first.
+    """
+    if isinstance(vectorstore, LocalVectorStore):
+        rows, scores = vectorstore.search_rows(embedding, fetch_k)
+        documents = [vectorstore._to_document(row) for row in rows]
+        return documents, scores, np.asarray(vectorstore.vectors[rows], dtype=np.float32)
+
+    # Pinecone: one query returning metadata and values, as the LangChain MMR path does
+    results = vectorstore._index.query([embedding], top_k=fetch_k, include_values=True,
+                                       include_metadata=True, namespace=vectorstore._namespace)
+    matches = results['matches']
+    documents = []
+    for match in matches:
+        metadata = dict(match['metadata'])
+        documents.append(Document(page_content=metadata.pop(vectorstore._text_key), metadata=metadata))
+    scores = np.array([match['score'] for match in matches], dtype=np.float32)
+    matrix = np.array([match['values'] for match in matches], dtype=np.float32).reshape(len(matches), -1)
+    return documents, scores, normalize(matrix)
+
+
+class MMRRetriever(BaseRetriever):
+    """Retriever doing candidate fetching and MMR selection in batched NumPy.
+
+    Candidates scoring below `score_threshold` (cosine similarity) are dropped before MMR,
+    so a question with no relevant chunks gets fewer than `k` documents instead of noise.
+    With a `keyword_index`, a BM25 search runs in parallel with embedding and vector search,
+    and the MMR-ordered dense candidates and the BM25 results are fused by reciprocal rank.
+    With a `reranker`, the best candidates are reordered by a cross-encoder before the top
+    `k` are kept.
+    With a `packer`, the selected chunks are deduplicated and packed under its token budget.
+    Within a request the async path respects the request's Deadline (see llmodels/deadline.py).
+    """
+
+    vectorstore: VectorStore
+    embeddings: Embeddings
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    score_threshold: float = 0.3
+    keyword_index: Optional[BM25Index] = None
+    rrf_k: int = 60
+    reranker: Optional[Reranker] = None
+    packer: Optional[ContextPacker] = None
+
+    def dense_ranking(self, embedding: List[float]) -> List[Document]:
+        documents, scores, matrix = fetch_candidates(self.vectorstore, embedding, self.fetch_k)
+        keep = np.flatnonzero(scores >= self.score_threshold)
+        if keep.size == 0:
+            return []
+        query = normalize(np.asarray(embedding, dtype=np.float32))
+        # Fusion and reranking reorder the whole MMR order, not just the top k
+        count = keep.size if self.keyword_index is not None or self.reranker is not None else self.k
+        selected = mmr_select(query, matrix[keep], count, self.lambda_mult)
+        return [documents[keep[i]] for i in selected]
+
+    def keyword_ranking(self, query: str) -> List[Document]:
+        with timed('keyword_search'):
+            return [document for document, _ in self.keyword_index.search(query, self.fetch_k)]
+
+    def rank(self, dense: List[Document], keyword: Optional[List[Document]] = None) -> List[Document]:
+        if keyword is None:
+            return dense
+        return [document for document, _ in reciprocal_rank_fusion([dense, keyword], self.rrf_k)]
+
+    def finish(self, ranked: List[Document]) -> List[Document]:
+        deadline = current_deadline()
+        documents = ranked[:deadline.chunks(self.k) if deadline is not None else self.k]
+        return self.packer.pack(documents) if self.packer is not None else documents
+
+    def select(self, embedding: List[float], query: str = None) -> List[Document]:
+        keyword = self.keyword_ranking(query) if self.keyword_index is not None and query else None
+        ranked = self.rank(self.dense_ranking(embedding), keyword)
+        if self.reranker is not None and query:
+            with timed('rerank'):
+                ranked = self.reranker.rerank(query, ranked)
+        return self.finish(ranked)
+
+    async def rerank(self, query: str, ranked: List[Document], deadline=None) -> List[Document]:
+        if deadline is None:
+            return await self.reranker.arerank(query, ranked)
+        remaining = deadline.retrieval_remaining()
+        if remaining <= 0:
+            deadline.degrade('rerank_skipped')
+            return ranked[:self.reranker.candidates]
+        return await self.reranker.arerank(query, ranked, max_seconds=remaining)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.select(self.embeddings.embed_query(query), query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # The keyword search does not need the embedding, so it starts right away
+        keyword = (asyncio.ensure_future(asyncio.to_thread(self.keyword_ranking, query))
+                   if self.keyword_index is not None else None)
+        deadline = current_deadline()
+        try:
+            try:
+                with timed('embed', once=True):
+                    embedding = await bounded(self.embeddings.aembed_query(query), 'embed')
+                with timed('search'):
+                    dense = await bounded(asyncio.to_thread(self.dense_ranking, embedding), 'search')
+            except DeadlineExceeded:
+                # Out of retrieval time: the keyword ranking alone, if there is one
+                if keyword is None:
+                    raise
+                deadline.degrade('keyword_only')
+                dense = []
+            keyword_ranking = None
+            if keyword is not None:
+                try:
+                    keyword_ranking = await bounded(keyword, 'keyword_search')
+                except DeadlineExceeded:
+                    if not dense:
+                        raise
+                    deadline.degrade('dense_only')
+            ranked = self.rank(dense, keyword_ranking)
+            if self.reranker is not None:
+                with timed('rerank'):
+                    ranked = await self.rerank(query, ranked, deadline)
+            return await asyncio.to_thread(self.finish, ranked)
+        finally:
+            if keyword is not None and not keyword.done():
+                keyword.cancel()
@@ -0,0 +1,96 @@
+import re
+from typing import List, Tuple
+
+from langchain.schema import BaseMessage, HumanMessage
+
+# Words that point back into the conversation (English, Swedish, Vietnamese)
+REFERRING_WORDS = {
+    'it', 'its', 'they', 'them', 'their', 'this', 'that', 'these', 'those', 'there', 'he', 'she', 'him', 'her',
+    'det', 'den', 'dessa', 'de', 'dem', 'där',
+    'nó', 'đó', 'này', 'vậy', 'thế',
+}
+# Openings of elliptical follow-ups ("what about housing?")
+FOLLOWUP_PREFIXES = ('what about', 'how about', 'and ', 'also ', 'what if', 'same ', 'or ', 'then ',
+                     'och ', 'vad gäller', 'còn ')
+# References that need the earlier answers, not just the last question
+ANSWER_REFERENCES = ('you said', 'you mentioned', 'earlier', 'previous', 'above', 'the first one',
+                     'the second one', 'the last one', 'that answer')
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+class QueryRewriter:
+    """Turns a follow-up into a standalone question without an LLM call where possible.
+
+    ConversationalRetrievalChain condenses every question asked with chat history through an
+    extra LLM call before retrieval. Instead each question takes one of three paths:
+
+    - standalone: no history, or nothing in the question refers back; sent without history
+    - local: a short elliptical or referring follow-up; the previous (standalone) question is
+      prepended ("How much does it cost to study in Sweden? What about housing?") and the
+      question is sent without history
+    - llm: the question needs the earlier answers or is too long to rewrite by template;
+      the history is kept and the chain condenses it with the LLM
+
+    `mode` 'llm' sends every question with history through the LLM, 'local' never does.
+    Sessions record the rewritten question, so a chain of follow-ups keeps its context, up
+    to `max_rewrite_words`.
+    """
+
+    def __init__(self, mode: str = 'auto', max_local_words: int = 12, max_rewrite_words: int = 64):
+        self.mode = mode
+        self.max_local_words = max_local_words
+        self.max_rewrite_words = max_rewrite_words
+        self.counts = {'standalone': 0, 'local': 0, 'llm': 0}
+
+    @staticmethod
+    def previous_question(history: List[BaseMessage]) -> str:
+        for message in reversed(history):
+            if isinstance(message, HumanMessage):
+                return message.content
+            if isinstance(message, tuple):
+                return message[0]
+        return ''
+
+    def classify(self, question: str, history: List[BaseMessage]) -> str:
+        if not history:
+            return 'standalone'
+        if self.mode == 'llm':
+            return 'llm'
+        text = ' '.join(question.lower().split())
+        words = WORD.findall(text)
+        # Checked first: these need the history even without a referring pronoun
+        # ("what did you mention above about the fee?")
+        if any(reference in text for reference in ANSWER_REFERENCES):
+            return 'local' if self.mode == 'local' else 'llm'
+        elliptical = text.startswith(FOLLOWUP_PREFIXES) or len(words) <= 3
+        referring = any(word in REFERRING_WORDS for word in words)
+        if not elliptical and not referring:
+            return 'standalone'
+        if self.mode == 'local':
+            return 'local'
+        previous = self.previous_question(history)
+        if (len(words) > self.max_local_words
+                or not previous
+                or len(WORD.findall(previous)) + len(words) > self.max_rewrite_words):
+            return 'llm'
+        return 'local'
+
+    def rewrite(self, prompt: dict) -> Tuple[dict, str]:
+        """Returns the prompt to run the chain with, and the path taken."""
+        question, history = prompt['question'], prompt['chat_history']
+        path = self.classify(question, history)
+        self.counts[path] += 1
+        if path == 'llm':
+            return prompt, path
+        if path == 'local':
+            question = f'{self.previous_question(history)} {question}'
+        return {'question': question, 'chat_history': []}, path
+
+    def stats(self) -> dict:
+        total = sum(self.counts.values())
+        return {
+            'mode': self.mode,
+            **self.counts,
+            'llm_rate': self.counts['llm'] / total if total else 0.0,
+        }
@@ -0,0 +1,159 @@
+import asyncio
+import secrets
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from langchain.schema import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+Turn = Tuple[str, str]
+Summarizer = Callable[[str, List[Turn]], Awaitable[str]]
+
+
+class Session:
+    """Rolling conversation state: a summary of older turns plus the recent turns verbatim."""
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.summary = ''
+        self.turns: List[Turn] = []
+        self.turn_tokens: List[int] = []
+        self.last_used = time.monotonic()
+        self.compacting = False
+
+    def chat_history(self) -> List[BaseMessage]:
+        """History in the form ConversationalRetrievalChain condenses the question from."""
+        history: List[BaseMessage] = []
+        if self.summary:
+            history.append(SystemMessage(content=f"Summary of the earlier conversation: {self.summary}"))
+        for question, answer in self.turns:
+            history.append(HumanMessage(content=question))
+            history.append(AIMessage(content=answer))
+        return history
+
+
+class SessionStore:
+    """In-memory conversation sessions keyed by the `session_state` token of the response frames.
+
+    The client sends only its new message together with the token it got back last time.
+    Recent turns are kept verbatim up to `history_tokens`; older turns are folded into a
+    running summary by `summarize` in the background, after the answer has been streamed.
+    Sessions idle for `idle_ttl` seconds, and the least recently used ones beyond
+    `max_sessions`, are evicted. Sessions live in the worker process that created them: with
+    several workers a client landing on another worker starts a new session.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], summarize: Summarizer, history_tokens: int = 512,
+                 max_sessions: int = 10000, idle_ttl: float = 1800):
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.history_tokens = history_tokens
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.created = 0
+        self.resumed = 0
+        self.evicted = 0
+        self.summarizations = 0
+        self.summarization_errors = 0
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._tasks = set()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and now - session.last_used < self.idle_ttl:
+                break
+            del self._sessions[session.id]
+            self.evicted += 1
+
+    def resume(self, session_id: Optional[str], history: List[Turn] = ()) -> Session:
+        """The session for `session_id`, or a new one seeded with the client-sent `history`."""
+        self._evict()
+        session = self._sessions.get(session_id) if session_id else None
+        if session is not None:
+            self.resumed += 1
+        else:
+            session = Session(secrets.token_urlsafe(16))
+            self._sessions[session.id] = session
+            self.created += 1
+            for question, answer in history:
+                self._append(session, question, answer)
+            self._compact_later(session)
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(session.id)
+        return session
+
+    def record(self, session: Session, question: str, answer: str):
+        """Add a finished turn; summarizes older turns in the background if over budget."""
+        self._append(session, question, answer)
+        session.last_used = time.monotonic()
+        self._compact_later(session)
+
+    def _append(self, session: Session, question: str, answer: str):
+        session.turns.append((question, answer))
+        session.turn_tokens.append(self.count_tokens(question) + self.count_tokens(answer))
+
+    def _compact_later(self, session: Session):
+        if session.compacting or sum(session.turn_tokens) <= self.history_tokens:
+            return
+        session.compacting = True
+        task = asyncio.get_running_loop().create_task(self._compact(session))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, session: Session):
+        try:
+            while sum(session.turn_tokens) > self.history_tokens and len(session.turns) > 1:
+                # Fold the oldest turns until the rest fits, keeping at least the last turn
+                folded = []
+                while sum(session.turn_tokens) > self.history_tokens and len(session.turns) > 1:
+                    folded.append(session.turns.pop(0))
+                    session.turn_tokens.pop(0)
+                try:
+                    session.summary = await self.summarize(session.summary, folded)
+                    self.summarizations += 1
+                except Exception as e:
+                    # Losing the folded turns is better than failing the conversation
+                    self.summarization_errors += 1
+                    print(f"Session summary failed: {e}")
+        finally:
+            session.compacting = False
+
+    def stats(self) -> dict:
+        return {
+            'sessions': len(self._sessions),
+            'created': self.created,
+            'resumed': self.resumed,
+            'evicted': self.evicted,
+            'summarizations': self.summarizations,
+            'summarization_errors': self.summarization_errors,
+        }
+
+
+def format_turns(turns: List[Turn]) -> str:
+    return '\n'.join(f"Human: {question}\nAI: {answer}" for question, answer in turns)
+
+
+def llm_summarizer(get_llm: Callable) -> Summarizer:
+    """Progressive summary written by the LLM (LangChain's ConversationSummaryMemory prompt)."""
+    from langchain.memory.prompt import SUMMARY_PROMPT
+
+    async def summarize(summary: str, turns: List[Turn]) -> str:
+        text = await get_llm().apredict(SUMMARY_PROMPT.format(summary=summary, new_lines=format_turns(turns)))
+        return text.strip()
+    return summarize
+
+
+def extractive_summarizer(count_tokens: Callable[[str], int], max_tokens: int) -> Summarizer:
+    """Summary without an LLM call: the earlier questions, most recent kept when over `max_tokens`.
+
+    For backends where an extra generation would hold up the only model instance.
+    """
+
+    async def summarize(summary: str, turns: List[Turn]) -> str:
+        questions = [q for q in summary.split('\n') if q] + [f"The human asked: {q}" for q, _ in turns]
+        while len(questions) > 1 and count_tokens('\n'.join(questions)) > max_tokens:
+            questions.pop(0)
+        return '\n'.join(questions)
+    return summarize
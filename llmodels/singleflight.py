@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional
+
+from llmodels.metrics import current_timer
+from llmodels.streaming import Sources
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    """One generation shared by every request that asked the same question while it ran.
+
+    Tokens are kept for the lifetime of the flight, so a late subscriber first replays what
+    was already produced and then follows the live stream. The retrieved sources, once
+    known, come first.
+    """
+
+    def __init__(self):
+        self.tokens: list[str] = []
+        self.sources: Optional[Sources] = None
+        self.finished = False
+        self.completed = False
+        self.subscribers = 0
+        self.abandoned = False      # cancelled because every subscriber went away
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _wake(self):
+        # Wake everyone waiting on the current event; later waits use a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def push(self, token: str):
+        self.tokens.append(token)
+        self._wake()
+
+    def set_sources(self, sources: Sources):
+        self.sources = sources
+        self._wake()
+
+    def finish(self, completed: bool):
+        self.finished = True
+        self.completed = completed
+        self._wake()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        position = 0
+        sources_sent = False
+        while True:
+            if not sources_sent and self.sources is not None:
+                sources_sent = True
+                yield self.sources
+            while position < len(self.tokens):
+                yield self.tokens[position]
+                position += 1
+            if self.finished:
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """Coalesces concurrent generations for the same key.
+
+    The first request for a key starts `generate(flight)` as a task of its own; requests for
+    the same key arriving before it finishes subscribe to that flight instead of starting
+    another retrieval and LLM stream. The task is not tied to the request that started it:
+    it keeps running while any subscriber is connected and is cancelled when the last one
+    leaves. A key of None never coalesces. `join` yields the flight and whether this request
+    started it.
+    """
+
+    def __init__(self):
+        self.started = 0
+        self.coalesced = 0
+        self.abandoned = 0
+        self._flights: Dict[Hashable, Flight] = {}
+
+    @asynccontextmanager
+    async def join(self, key: Optional[Hashable], generate: Callable[[Flight], Awaitable[bool]]):
+        flight = self._flights.get(key) if key is not None else None
+        if flight is None:
+            flight = Flight()
+            if key is not None:
+                self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, generate))
+            self.started += 1
+            started = True
+        else:
+            self.coalesced += 1
+            started = False
+        flight.subscribers += 1
+        try:
+            yield flight, started
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.task.done():
+                flight.abandoned = True
+                flight.task.cancel()
+                self.abandoned += 1
+
+    async def _run(self, key: Optional[Hashable], flight: Flight, generate: Callable[[Flight], Awaitable[bool]]):
+        completed = False
+        try:
+            completed = await generate(flight)
+        except Exception as e:
+            # The task runs in the starting request's context, so the failure is counted there
+            logger.exception("Generation failed")
+            timer = current_timer()
+            if timer is not None:
+                timer.error(e)
+        finally:
+            if key is not None and self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.finish(completed)
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._flights),
+            'generations_started': self.started,
+            'requests_coalesced': self.coalesced,
+            'generations_abandoned': self.abandoned,
+        }
@@ -0,0 +1,210 @@
+import codecs
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.llms.base import LLM
+
+from llmodels import llama2
+
+speculative_stats = {'steps': 0, 'tokens': 0, 'drafted': 0, 'accepted': 0, 'decode_seconds': 0.0}
+
+
+class NGramDrafter:
+    """Drafts the next tokens by looking up the last tokens earlier in the sequence.
+
+    The sequence is the prompt, which holds the retrieved sources, followed by the answer so
+    far. Answers copy long phrases from the sources, so when the last `ngram` (down to 1)
+    tokens also occur earlier, the up to `k` tokens that followed that occurrence are a good
+    guess for what comes next. The latest occurrence wins.
+    """
+
+    def __init__(self, tokens: List[int], ngram: int = 3, k: int = 8):
+        self.ngram = ngram
+        self.k = k
+        self.tokens = list(tokens)
+        self._ends: Dict[Tuple[int, ...], int] = {}
+        self._indexed = 0
+
+    def extend(self, tokens: List[int]):
+        self.tokens.extend(tokens)
+
+    def _index(self, end: int):
+        # n-grams ending before `end`, so the query n-gram does not find itself
+        for i in range(self._indexed + 1, end):
+            for n in range(1, self.ngram + 1):
+                if i - n >= 0:
+                    self._ends[tuple(self.tokens[i - n:i])] = i
+        self._indexed = max(self._indexed, end - 1)
+
+    def propose(self, limit: int) -> List[int]:
+        end = len(self.tokens)
+        self._index(end)
+        for n in range(min(self.ngram, end), 0, -1):
+            start = self._ends.get(tuple(self.tokens[end - n:]))
+            if start is not None:
+                return self.tokens[start:start + min(self.k, limit)]
+        return []
+
+
+class SpeculativeModel:
+    """Llama 2 decoding where the model verifies drafted tokens in batches.
+
+    Each step evaluates the next token together with the tokens drafted after it by an
+    NGramDrafter, in one forward pass. The model's logits at every position of the batch
+    decide how many drafts it agrees with; those are kept with the token the model picks
+    after them, and the KV entries of the rejected drafts are discarded. On CPU a pass over
+    a few tokens costs little more than a pass over one, so copied phrases are produced
+    several tokens per pass.
+
+    Tokens are chosen greedily after the repetition penalty, so the answer is the one plain
+    greedy decoding would give. Drafting only changes how fast it comes. The ctransformers
+    path samples at `temperature` instead, so its answers can differ slightly.
+
+    ctransformers only exposes the logits of the last evaluated token, so this runs the same
+    GGML file through llama-cpp-python with `logits_all`. It provides the parts of the
+    ctransformers LLM interface used by llama2 (`tokenize`, `_context`, `eval`,
+    `prepare_inputs_for_generation` and streaming `__call__`), so prompt prefix reuse and the
+    worker pool work unchanged.
+
+    Relies on `Llama` of llama-cpp-python 0.1.78: `eval` continues at `n_tokens`, and
+    `scores` is the (n_ctx, n_vocab) array whose row i holds the logits after token i.
+    """
+
+    def __init__(self, model_path: str, context_length: int = 2048, max_new_tokens: int = 256,
+                 repetition_penalty: float = 1.1, last_n_tokens: int = 64, threads: Optional[int] = None,
+                 draft_tokens: int = 8, draft_ngram: int = 3):
+        from llama_cpp import Llama
+        self.model = Llama(model_path=model_path, n_ctx=context_length, n_threads=threads, logits_all=True,
+                           verbose=False)
+        self.max_new_tokens = max_new_tokens
+        self.repetition_penalty = repetition_penalty
+        self.last_n_tokens = last_n_tokens
+        self.draft_tokens = draft_tokens
+        self.draft_ngram = draft_ngram
+        self._context: List[int] = []   # tokens whose KV entries are in the model
+
+    def tokenize(self, text: str) -> List[int]:
+        return self.model.tokenize(text.encode('utf-8'), add_bos=True)
+
+    def eval(self, tokens: List[int]):
+        # Evaluation continues after _context, overwriting KV entries of discarded tokens
+        self.model.n_tokens = len(self._context)
+        self.model.eval(tokens)
+        self._context.extend(tokens)
+
+    def prepare_inputs_for_generation(self, tokens: List[int], reset: bool = True) -> List[int]:
+        """Keep the longest common prefix with the evaluated tokens; returns the rest to evaluate."""
+        n = min(len(tokens) - 1, len(self._context))
+        i = 0
+        while i < n and tokens[i] == self._context[i]:
+            i += 1
+        del self._context[i:]
+        return tokens[i:]
+
+    def _choose(self, logits: np.ndarray, history: List[int]) -> int:
+        logits = np.array(logits, dtype=np.float32)
+        recent = np.unique(np.asarray(history[-self.last_n_tokens:], dtype=np.int64))
+        penalized = logits[recent]
+        logits[recent] = np.where(penalized > 0, penalized / self.repetition_penalty,
+                                  penalized * self.repetition_penalty)
+        return int(np.argmax(logits))
+
+    def generate(self, tokens: List[int]):
+        """Yields the answer tokens for the prompt `tokens`."""
+        self.eval(self.prepare_inputs_for_generation(tokens))
+        logits = self.model.scores[len(self._context) - 1]
+        drafter = NGramDrafter(tokens, self.draft_ngram, self.draft_tokens)
+        eos = self.model.token_eos()
+        produced = 0
+        while produced < self.max_new_tokens:
+            token = self._choose(logits, self._context)
+            if token == eos:
+                return
+            drafter.extend([token])
+            drafts = drafter.propose(self.max_new_tokens - produced - 1)
+            start = len(self._context)
+            started = time.monotonic()
+            self.eval([token] + drafts)
+            rows = self.model.scores[start:start + 1 + len(drafts)]
+            accepted = [token]
+            for i, draft in enumerate(drafts):
+                if self._choose(rows[i], self._context[:start + i + 1]) != draft:
+                    break
+                accepted.append(draft)
+            del self._context[start + len(accepted):]
+            drafter.tokens[start + 1:] = accepted[1:]
+            logits = rows[len(accepted) - 1]
+            speculative_stats['decode_seconds'] += time.monotonic() - started
+            speculative_stats['steps'] += 1
+            speculative_stats['drafted'] += len(drafts)
+            speculative_stats['accepted'] += len(accepted) - 1
+            speculative_stats['tokens'] += len(accepted)
+            for token in accepted:
+                if token == eos:
+                    return
+                produced += 1
+                yield token
+
+    def __call__(self, prompt: str, stop: Optional[List[str]] = None, stream: bool = True):
+        """Streams the answer text, ending before the first of the `stop` sequences."""
+        stop = stop or []
+        stop_regex = re.compile('|'.join(map(re.escape, stop))) if stop else None
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        text = ''
+        for token in self.generate(self.tokenize(prompt)):
+            text += decoder.decode(self.model.detokenize([token]))
+            if stop_regex is not None:
+                match = stop_regex.search(text)
+                if match:
+                    text = text[:match.start()]
+                    break
+            # Hold back a suffix that may be the start of a stop sequence
+            held = max((i for s in stop for i in range(len(s), 0, -1) if text.endswith(s[:i])), default=0)
+            if len(text) > held:
+                yield text[:len(text) - held]
+                text = text[len(text) - held:]
+        if text:
+            yield text
+
+
+class SpeculativeLlama(llama2.ThreadStreaming, LLM):
+    """LangChain LLM over a SpeculativeModel, run on the llama2 model thread."""
+
+    client: Any  #: :meta private:
+
+    @property
+    def _llm_type(self) -> str:
+        return 'llama2_speculative'
+
+    def _executor(self):
+        return llama2._model_thread
+
+    def _generate_tokens(self, prompt: str, stop: Optional[List[str]], on_token, cancelled) -> str:
+        return llama2.run_local(self.client, prompt, stop, on_token, cancelled)
+
+
+def load_speculative_model(threads: Optional[int] = None, draft_tokens: int = 8, draft_ngram: int = 3) -> SpeculativeLlama:
+    from huggingface_hub import hf_hub_download
+    config = llama2.config
+    model = SpeculativeModel(hf_hub_download(llama2.model_id, llama2.model_file),
+                             context_length=config['context_length'],
+                             max_new_tokens=config['max_new_tokens'],
+                             repetition_penalty=config['repetition_penalty'],
+                             threads=threads,
+                             draft_tokens=draft_tokens,
+                             draft_ngram=draft_ngram)
+    return SpeculativeLlama(client=model)
+
+
+def stats() -> dict:
+    steps, tokens, drafted = speculative_stats['steps'], speculative_stats['tokens'], speculative_stats['drafted']
+    seconds = speculative_stats['decode_seconds']
+    return {
+        **speculative_stats,
+        'acceptance_rate': speculative_stats['accepted'] / drafted if drafted else 0.0,
+        # Answer tokens per forward pass of the model; plain decoding makes one
+        'tokens_per_step': tokens / steps if steps else 0.0,
+        'tokens_per_second': tokens / seconds if seconds else 0.0,
+    }
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List
+from uuid import UUID
+
+import anyio
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.schema import Document
+from starlette.responses import StreamingResponse
+
+SENTENCE_ENDINGS = ('.', '!', '?', ':', ';', '\n')
+
+
+def is_combine_docs_chain(serialized: Dict[str, Any]) -> bool:
+    """Whether a chain run is the one stuffing the retrieved documents into the QA prompt."""
+    return (serialized or {}).get('id', [None])[-1] == 'StuffDocumentsChain'
+
+
+class Sources(list):
+    """Sources of the answer (dicts with source, title, updated), sent as a frame of their own."""
+
+    @classmethod
+    def from_documents(cls, documents: List[Document]) -> 'Sources':
+        sources, seen = cls(), set()
+        for document in documents:
+            url = document.metadata.get('source')
+            if url in seen:
+                continue
+            seen.add(url)
+            sources.append({key: document.metadata.get(key) for key in ('source', 'title', 'updated')})
+        return sources
+
+
+class AnswerStreamCallback(AsyncIteratorCallbackHandler):
+    """Iterator over the tokens of the answer only.
+
+    With chat history, ConversationalRetrievalChain first calls the LLM to condense the
+    follow-up into a standalone question. Those tokens are not part of the answer, and the
+    end of that call must not end the stream, so only the LLM run started by the
+    combine-docs chain is forwarded.
+
+    The documents the chain retrieves are passed to `on_sources` as Sources as soon as
+    retrieval ends, before the answer LLM starts.
+    """
+
+    def __init__(self, on_sources=None):
+        super().__init__()
+        self._in_combine_docs = False
+        self._answer_run = None
+        self._on_sources = on_sources
+        self.sources = None
+
+    async def on_retriever_end(self, documents, **kwargs: Any):
+        if self.sources is None:
+            self.sources = Sources.from_documents(documents)
+            if self._on_sources is not None:
+                self._on_sources(self.sources)
+
+    async def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any):
+        if is_combine_docs_chain(serialized):
+            self._in_combine_docs = True
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any):
+        if self._in_combine_docs and self._answer_run is None:
+            self._answer_run = run_id
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        if run_id == self._answer_run:
+            await super().on_llm_new_token(token)
+
+    async def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        if run_id == self._answer_run:
+            self.done.set()
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        if run_id == self._answer_run:
+            self.done.set()
+
+
+class FlushPolicy:
+    """When to turn buffered tokens into a frame.
+
+    The first token is always sent on its own so the answer starts rendering immediately.
+    After that the buffer is flushed as soon as any limit is reached: `max_tokens` tokens,
+    `max_bytes` UTF-8 bytes, `max_latency_ms` since the oldest buffered token, or a sentence
+    boundary once at least `min_sentence_tokens` tokens are buffered.
+    """
+
+    def __init__(self, max_tokens: int = 16, max_bytes: int = 512, max_latency_ms: float = 60,
+                 flush_on_sentence: bool = True, min_sentence_tokens: int = 3):
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency_ms / 1000
+        self.flush_on_sentence = flush_on_sentence
+        self.min_sentence_tokens = min_sentence_tokens
+
+    def should_flush(self, buffer: list[str], buffered_bytes: int) -> bool:
+        if len(buffer) >= self.max_tokens or buffered_bytes >= self.max_bytes:
+            return True
+        return (self.flush_on_sentence
+                and len(buffer) >= self.min_sentence_tokens
+                and buffer[-1].rstrip(' ').endswith(SENTENCE_ENDINGS))
+
+
+class FrameWriter:
+    """Encodes chat frames as newline-delimited JSON or as server-sent events (`data: ...`).
+
+    `session_state` is echoed in every frame; clients send it back with their next message.
+    """
+
+    def __init__(self, sse: bool = False, session_state: str = None):
+        self.sse = sse
+        self.session_state = session_state
+
+    @property
+    def media_type(self) -> str:
+        return 'text/event-stream' if self.sse else 'application/x-ndjson'
+
+    def encode(self, payload: dict) -> str:
+        data = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+        return f'data: {data}\n\n' if self.sse else f'{data}\n'
+
+    def frame(self, delta: dict, context: dict = None, session_state=None) -> str:
+        return self.encode({
+            'choices': [{
+                'index': 0,
+                'delta': delta,
+                'context': context if context is not None else {'followup_questions': []},
+                'session_state': session_state if session_state is not None else self.session_state,
+            }]
+        })
+
+    def delta(self, content: str) -> str:
+        return self.frame({'content': content})
+
+    def end(self) -> str:
+        return self.frame({})
+
+    def sources(self, sources: Sources) -> str:
+        return self.frame({}, {'followup_questions': [], 'data_points': sources})
+
+    async def stream(self, tokens: AsyncIterator[str], policy: FlushPolicy) -> AsyncIterator[str]:
+        """Coalesce `tokens` into delta frames according to `policy`, then send the end frame.
+
+        A Sources item among the tokens is sent as a sources frame right away."""
+        queue = asyncio.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for token in tokens:
+                    queue.put_nowait(token)
+            finally:
+                queue.put_nowait(done)
+
+        pump_task = asyncio.create_task(pump())
+        buffer, buffered_bytes, first_sent, deadline = [], 0, False, None
+        try:
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    token = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    token = None
+                if token is done:
+                    break
+                if isinstance(token, Sources):
+                    if buffer:
+                        yield self.delta(''.join(buffer))
+                        buffer, buffered_bytes, first_sent, deadline = [], 0, True, None
+                    yield self.sources(token)
+                    continue
+                if token is not None:
+                    if not buffer:
+                        deadline = time.monotonic() + policy.max_latency
+                    buffer.append(token)
+                    buffered_bytes += len(token.encode('utf-8'))
+                if buffer and (token is None or not first_sent or policy.should_flush(buffer, buffered_bytes)):
+                    yield self.delta(''.join(buffer))
+                    buffer, buffered_bytes, first_sent, deadline = [], 0, True, None
+            if buffer:
+                yield self.delta(''.join(buffer))
+            yield self.end()
+        finally:
+            pump_task.cancel()
+
+
+class DisconnectAwareStreamingResponse(StreamingResponse):
+    """StreamingResponse that closes its body generator as soon as streaming stops.
+
+    Starlette cancels `stream_response` when the client disconnects, but leaves the body
+    generator suspended until it is garbage collected. Closing it right away runs the
+    generator's `finally` block, which is where the generation task gets cancelled.
+    """
+
+    async def stream_response(self, send) -> None:
+        try:
+            await super().stream_response(send)
+        finally:
+            aclose = getattr(self.body_iterator, 'aclose', None)
+            if aclose is not None:
+                with anyio.CancelScope(shield=True):
+                    await aclose()
@@ -0,0 +1,31 @@
+#%% 1.Import libraries
+import os                                                           # Functions for interacting with the operating system
+import sys                                                          # Command line arguments
+from glob import glob                                               # File name pattern matching
+from torch import cuda                                              # PyTorch's CUDA library for GPU computations
+from langchain.embeddings.huggingface import HuggingFaceEmbeddings  # Provides Hugging Face's transformer models for text embeddings
+from dotenv import load_dotenv                                      # Reads .env files and sets environment variables
+
+from llmodels.local_index import build_local_index
+
+#%% 2.Set parameters and environment variables
+load_dotenv()
+
+# Usage: python local_index_build.py [chunk jsonl files...]
+chunk_files = sys.argv[1:] or glob(os.path.join('data_crawler', 'crawled_data', '*.jsonl'))
+index_dir = os.environ.get('LOCAL_INDEX_DIR', 'local_index')
+use_hnsw = os.environ.get('LOCAL_INDEX_HNSW', '0') == '1'
+
+# Must be the same model as the query-side embed model in llmodels/rag.py
+embed_model_id = 'sentence-transformers/all-MiniLM-L6-v2'
+
+device = f'cuda:{cuda.current_device()}' if cuda.is_available() else 'cpu'
+embed_model = HuggingFaceEmbeddings(
+    model_name=embed_model_id,
+    model_kwargs={'device': device},
+    encode_kwargs={'device': device, 'batch_size': 32}
+)
+
+#%% 3.Embed chunks and write the memory-mapped index
+build_local_index(chunk_files, index_dir, embed_model, hnsw=use_hnsw)
+print(f"Local index written to {index_dir} from {len(chunk_files)} chunk file(s)")
@@ -65,7 +65,9 @@ for i in range(0, len(data), batch_size):
     metadata = [
         {'text': x['chunk'],
          'source': x['source'],
-         'title': x['title']} for i, x in batch.iterrows()
+         'title': x['title'],
+         'chunk-id': str(x['chunk-id']),
+         'updated': str(x['updated'])} for i, x in batch.iterrows()
     ]
     # add to Pinecone
     index.upsert(vectors=zip(ids, embeds, metadata))
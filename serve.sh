@@ -1,7 +1,11 @@
 SSL_KEY_FILE=key.pem
 SSL_CERT_FILE=cert.pem
+# WEB_WORKERS>1 runs several pre-forked workers sharing the model weights (see serve_prefork.py)
+WEB_WORKERS=${WEB_WORKERS:-1}
 
-if [ -f "$SSL_CERT_FILE" ]; then
+if [ "$WEB_WORKERS" -gt 1 ]; then
+    WEB_WORKERS=$WEB_WORKERS python serve_prefork.py
+elif [ -f "$SSL_CERT_FILE" ]; then
     #gunicorn --keyfile key.pem --certfile cert.pem --config gunicorn_config.py api:app
     hypercorn --keyfile $SSL_KEY_FILE --certfile $SSL_CERT_FILE --bind 0.0.0.0:8000 stream_api:app
 else
@@ -0,0 +1,125 @@
+"""Pre-forking multi-worker server.
+
+Hypercorn's own `--workers` starts workers with multiprocessing 'spawn', so every worker
+re-imports the app and loads its own copy of the embedding model (and local llama weights).
+Here the parent loads the weights once, binds the socket, and fork()s the workers, which
+then share the model pages copy-on-write. Each worker runs its own hypercorn event loop on
+the inherited socket and finishes its warmup (Pinecone, vector store) itself.
+
+Usage: WEB_WORKERS=4 python serve_prefork.py
+"""
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+from dotenv import load_dotenv
+load_dotenv()
+
+WORKERS = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 8000))
+# Split the cores between workers so their torch thread pools do not oversubscribe the CPU
+TORCH_THREADS = int(os.environ.get('TORCH_THREADS_PER_WORKER', max(1, (os.cpu_count() or 1) // WORKERS)))
+# Seconds a worker keeps serving open streams after SIGTERM before closing them
+GRACEFUL_TIMEOUT = float(os.environ.get('GRACEFUL_TIMEOUT', 30))
+# Same files as serve.sh (SSL_CERT_FILE in the environment is OpenSSL's CA bundle, not ours)
+SSL_KEY_FILE = 'key.pem'
+SSL_CERT_FILE = 'cert.pem'
+
+
+def run_worker(sock: socket.socket):
+    import asyncio
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    import stream_api
+
+    # Ctrl-C reaches the whole process group; the parent turns it into a SIGTERM per worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        import torch
+        torch.set_num_threads(TORCH_THREADS)
+    except ImportError:
+        pass
+
+    config = Config()
+    config.bind = [f'fd://{sock.fileno()}']
+    config.graceful_timeout = GRACEFUL_TIMEOUT
+    if os.path.exists(SSL_CERT_FILE):
+        config.certfile = SSL_CERT_FILE
+        config.keyfile = SSL_KEY_FILE
+
+    async def main():
+        # SIGTERM stops accepting connections; open streams get GRACEFUL_TIMEOUT to finish
+        stopping = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        try:
+            await serve(stream_api.app, config, shutdown_trigger=stopping.wait)
+        except asyncio.CancelledError:
+            # hypercorn cancels connections still closing when it stops
+            if not stopping.is_set():
+                raise
+
+    asyncio.run(main())
+
+
+def fork_worker(sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(sock)
+        except BaseException as e:
+            print(f"Worker {os.getpid()} exited: {e!r}", file=sys.stderr)
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    from llmodels import rag
+    import stream_api  # noqa: F401  import the app once, before forking
+
+    rag.preload()
+    sock = socket.create_server((HOST, PORT), backlog=2048)
+    sock.set_inheritable(True)
+
+    # Move everything allocated so far out of the collector's reach, so garbage collection
+    # in the workers does not write to (and un-share) the parent's pages.
+    gc.freeze()
+
+    workers = {fork_worker(sock) for _ in range(WORKERS)}
+    print(f"Serving on {HOST}:{PORT} with {WORKERS} workers x {TORCH_THREADS} torch threads")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} died with status {status}, restarting", file=sys.stderr)
+            time.sleep(1)   # do not spin if workers crash on startup
+            workers.add(fork_worker(sock))
+
+
+if __name__ == '__main__':
+    main()
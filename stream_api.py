@@ -1,9 +1,20 @@
 import asyncio
-from llmodels.rag import get_generate_text, build_prompt
+import json
+import logging
+import os
+from llmodels.rag import chain_pool, build_prompt, llm_backend, embedder, semantic_cache, admission, sessions, rewriter, reranker, request_deadline, answer_batch, batch_concurrency, LLM_BACKEND, warmup, readiness
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from langchain.callbacks import AsyncIteratorCallbackHandler
+from llmodels.admission import AdmissionRejected, Ticket
+from llmodels import metrics
+from llmodels.deadline import AnswerTokenLimit, Deadline, DeadlineExceeded, bounded, current_deadline, deadline_stats
+from llmodels.embedding import normalize_query
+from llmodels.metrics import RequestTimer, current_timer, timed
+from llmodels.sessions import Session
+from llmodels.singleflight import Flight, SingleFlight
+from llmodels.streaming import AnswerStreamCallback, DisconnectAwareStreamingResponse, FlushPolicy, FrameWriter, Sources
 
 
 app = FastAPI()
@@ -15,57 +26,242 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-async def run(prompt):
-    stream_callback = AsyncIteratorCallbackHandler()
-    generate_text = get_generate_text(stream_callback)
-    task = asyncio.create_task(wrap_done(
-        generate_text.arun(prompt),
-        stream_callback.done)
-    )
-    yield '{"choices": [{"index": 0, "delta": {"content": " end"}, "context": {"followup_questions": [], "data_points": []}, "session_state": null}]}\n'
-    #await asyncio.sleep(0.1)
-    batch = 5
-    iter = 0
-    batch_string = ''
+flush_policy = FlushPolicy(max_tokens=int(os.environ.get('STREAM_FLUSH_TOKENS', 16)),
+                           max_bytes=int(os.environ.get('STREAM_FLUSH_BYTES', 512)),
+                           max_latency_ms=float(os.environ.get('STREAM_FLUSH_MS', 60)),
+                           flush_on_sentence=os.environ.get('STREAM_FLUSH_ON_SENTENCE', '1') == '1')
+
+# Generations stopped because the client went away, and the completion tokens they did not spend
+cancellation_stats = {'cancelled_generations': 0, 'tokens_saved_estimate': 0}
+
+inflight = SingleFlight()
+
+logger = logging.getLogger(__name__)
+
+metrics.track_admission(LLM_BACKEND, admission)
+
+async def run(prompt, writer: FrameWriter, ticket: Ticket, timer: RequestTimer, session: Session,
+              deadline: Deadline):
+    timer.activate()
+    deadline.activate()
+    try:
+        async for frame in answer(prompt, writer, ticket, timer, session):
+            timer.frame_sent(frame)
+            yield frame
+    except Exception:
+        timer.outcome = 'error'
+        raise
+    finally:
+        ticket.release()
+        timer.finish(timer.outcome or 'cancelled')
+
+async def answer(prompt, writer: FrameWriter, ticket: Ticket, timer: RequestTimer, session: Session):
+    with timed('rewrite'):
+        prompt, path = rewriter.rewrite(prompt)
+    timer.rewrite(path)
+    question = prompt['question']
+    use_cache = semantic_cache.enabled and not prompt['chat_history']
+    if use_cache:
+        try:
+            with timed('embed', once=True):
+                question_vector = await bounded(embedder.aembed_query(question), 'embed')
+        except DeadlineExceeded:
+            current_deadline().degrade('cache_skipped')
+            use_cache = False
+    if use_cache:
+        with timed('cache_lookup'):
+            cached = semantic_cache.lookup(question_vector)
+        if cached is not None:
+            async for frame in writer.stream(replay(cached.tokens, cached.sources), flush_policy):
+                yield frame
+            timer.outcome = 'cache_hit'
+            sessions.record(session, question, ''.join(cached.tokens))
+            return
+
+    # Identical standalone questions asked while an answer is being generated share it. A
+    # request with a shorter deadline of its own may get a cut-down answer, so it is not shared.
+    key = normalize_query(question) if not prompt['chat_history'] and not current_deadline().shortened else None
+    start = lambda flight: generate(prompt, flight, question_vector if use_cache else None)
+    # If the client disconnects mid-stream and nobody else is following this answer, leaving
+    # `join` cancels the chain (and its OpenAI stream or local generation loop).
+    async with inflight.join(key, start) as (flight, owner):
+        if not owner:
+            # Following another request's generation uses no backend capacity
+            ticket.release()
+        async for frame in writer.stream(flight.subscribe(), flush_policy):
+            yield frame
+
+    if flight.completed:
+        timer.outcome = 'completed' if owner else 'coalesced'
+        sessions.record(session, question, ''.join(flight.tokens))
+    else:
+        timer.outcome = 'deadline' if current_deadline().remaining() <= 0 else 'error'
+
+async def generate(prompt, flight: Flight, question_vector=None) -> bool:
+    """Run the chain, streaming the answer tokens into `flight`. Returns whether it completed."""
+    # Sources reach the subscribers as soon as the chain's retrieval ends, before any token
+    stream_callback = AnswerStreamCallback(on_sources=flight.set_sources)
+    llm_backend.use_shared_session()
+    # The task runs in the context of the request that started it, so its RequestTimer
+    # (the current one) gets the stage timings
+    callbacks = [stream_callback, current_timer()]
+    deadline = current_deadline()
+    async with chain_pool.acquire() as generate_text:
+        if deadline is not None:
+            # Chains are used by one request at a time, so the answer's llm_kwargs are this request's
+            callbacks.append(AnswerTokenLimit(deadline, generate_text.combine_docs_chain.llm_chain.llm_kwargs,
+                                              llm_backend.MAX_TOKENS))
+        task = asyncio.create_task(wrap_done(
+            generate_text.arun(prompt, callbacks=[c for c in callbacks if c is not None]),
+            stream_callback.done)
+        )
+        try:
+            await bounded(pump(stream_callback, flight), 'generate', retrieval=False)
+            completed = await task
+        except DeadlineExceeded:
+            # Out of time: the answer so far has been streamed, the chain is stopped below
+            completed = False
+        finally:
+            # Every subscriber went away: stop the chain instead of finishing it for nobody
+            if not task.done():
+                task.cancel()
+                if deadline is None or deadline.remaining() > 0:
+                    cancellation_stats['cancelled_generations'] += 1
+                    cancellation_stats['tokens_saved_estimate'] += max(0, llm_backend.MAX_TOKENS - len(flight.tokens))
+            generate_text.combine_docs_chain.llm_chain.llm_kwargs.pop('max_tokens', None)
+    # An answer degraded to meet the deadline (fewer chunks, shorter) is not served again
+    if completed and question_vector is not None and not (deadline is not None and deadline.degraded):
+        semantic_cache.store(question_vector, prompt['question'], flight.tokens, flight.sources)
+    return completed
+
+async def pump(stream_callback: AnswerStreamCallback, flight: Flight):
     async for token in stream_callback.aiter():
-        #print(token)
-        # Use server-sent-events to stream the response
-        if iter == batch:
-            yield '{"choices": [{"index": 0, "delta": {"content": "'+batch_string+'"}, "context": {"followup_questions": []}, "session_state": null}]}\n'
-            batch_string = ''
-            iter = 0
-        batch_string += token
-        iter += 1
-    yield '{"choices": [{"index": 0, "delta": {"content": "'+batch_string+'"}, "context": {"followup_questions": []}, "session_state": null}]}\n'
-
-    await task
-    #stream_callback.done.clear()
-    #await asyncio.sleep(0.1)
-    yield '{"choices": [{"index": 0, "delta": {}, "context": {"followup_questions": []}, "session_state": null}]}'
-    
-    # yield '{"choices": [{"index": 0, "delta": {"content": " end"}, "context": {"followup_questions": [], "data_points": []}, "session_state": null}]}\n'
-    # for i in range(100):
-    #     print(i)
-    #     yield '{"choices": [{"index": 0, "delta": {"content": "'+str(i)+'?aa "}, "context": {"followup_questions": []}, "session_state": null}]}\n'
-    # yield '{"choices": [{"index": 0, "delta": {}, "context": {"followup_questions": []}, "session_state": null}]}'
+        flight.push(token)
+
+async def replay(tokens: list, sources: Sources = None):
+    if sources is not None:
+        yield sources
+    for token in tokens:
+        yield token
 
 @app.post("/q")
 async def chat(request: Request):
     request_json = await request.json()
     messages = request_json.get("messages", [])
     prompt = build_prompt(messages)
-    return StreamingResponse(run(prompt), media_type="text/event-stream")
+    timer = RequestTimer(LLM_BACKEND)
+    deadline_ms = request_json.get("deadline_ms")
+    if deadline_ms is not None and (not isinstance(deadline_ms, (int, float)) or isinstance(deadline_ms, bool)
+                                    or deadline_ms <= 0):
+        return JSONResponse({"error": "deadline_ms must be a positive number"}, status_code=400)
+    # Starts now, so time spent in the admission queue counts; clients may ask for less
+    deadline = request_deadline((deadline_ms or 0) / 1000)
+    try:
+        ticket = await admission.acquire()
+    except AdmissionRejected as e:
+        timer.finish(f'rejected_{e.status_code}')
+        return JSONResponse({"error": e.reason}, status_code=e.status_code,
+                            headers={"Retry-After": str(e.retry_after)})
+    timer.mark('queue')
+    # Clients send the new message with the session_state of the previous answer. A client
+    # sending the whole conversation instead (or an unknown token) starts a session seeded with it.
+    session = sessions.resume(request_json.get("session_state"), prompt['chat_history'])
+    prompt = {"question": prompt['question'], "chat_history": session.chat_history()}
+    # Server-sent events for EventSource-style clients, newline-delimited JSON otherwise
+    writer = FrameWriter(sse='text/event-stream' in request.headers.get('accept', ''), session_state=session.id)
+    # The background release covers responses whose body never started streaming
+    return DisconnectAwareStreamingResponse(run(prompt, writer, ticket, timer, session, deadline),
+                                            media_type=writer.media_type,
+                                            background=BackgroundTask(ticket.release))
+
+# Questions accepted by one /batch request
+batch_max_questions = int(os.environ.get('BATCH_MAX_QUESTIONS', 1000))
+
+@app.post("/batch")
+async def batch(request: Request):
+    """Answer a list of standalone questions, one JSON line per answer as each completes."""
+    request_json = await request.json()
+    questions = request_json.get("questions")
+    if not isinstance(questions, list) or not all(isinstance(question, str) for question in questions):
+        return JSONResponse({"error": "questions must be a list of strings"}, status_code=400)
+    if len(questions) > batch_max_questions:
+        return JSONResponse({"error": f"at most {batch_max_questions} questions per batch"}, status_code=400)
+    concurrency = request_json.get("concurrency")
+    if concurrency is not None and (not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1):
+        return JSONResponse({"error": "concurrency must be a positive integer"}, status_code=400)
+    # Clients may ask for fewer answers at a time, not more
+    concurrency = min(concurrency or batch_concurrency, batch_concurrency)
+    llm_backend.use_shared_session()
+    return DisconnectAwareStreamingResponse(batch_lines(questions, concurrency), media_type="application/x-ndjson")
+
+async def batch_lines(questions: list, concurrency: int):
+    results = answer_batch(questions, concurrency)
+    try:
+        async for result in results:
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+    finally:
+        # Cancels the questions still being answered when the client disconnects
+        await results.aclose()
+
+@app.on_event("startup")
+async def start_warmup():
+    # The socket is bound before this runs; models load in the background and /readyz
+    # reports 503 until they are warm.
+    app.state.warmup = asyncio.get_running_loop().run_in_executor(None, warmup)
+    # warmup() logs its own failure; retrieve the exception so it is not reported again
+    app.state.warmup.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+@app.get("/healthz")
+async def healthz():
+    # Warmup retries with backoff; once it has given up this worker can never become
+    # ready, so it reports itself unhealthy to be restarted.
+    state = readiness()
+    if state['failed']:
+        return JSONResponse({"status": "warmup failed", "error": state['error']}, status_code=503)
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    state = readiness()
+    return JSONResponse(state, status_code=200 if state['ready'] else 503)
+
+@app.get("/stats")
+async def stats():
+    return {"admission": {"backend": LLM_BACKEND, **admission.stats()},
+            "semantic_cache": semantic_cache.stats(),
+            "embeddings": embedder.stats(),
+            "sessions": sessions.stats(),
+            "rewriter": rewriter.stats(),
+            "rerank": reranker.stats() if reranker is not None else None,
+            "cancellations": cancellation_stats,
+            "deadline": deadline_stats,
+            "llm": llm_backend.stats() if hasattr(llm_backend, 'stats') else None,
+            "single_flight": inflight.stats()}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, headers={"Content-Type": content_type})
 
 # Test: curl http://0.0.0.0:8000/q -X POST -d '{"messages": [{"content": "How much does it cost to study a Masters program in Sweden?"}]}' -H 'Content-Type: application/json'
+# Batch: curl -N http://0.0.0.0:8000/batch -X POST -d '{"questions": ["How much does it cost to study a Masters program in Sweden?", "Can I work while studying in Finland?"]}' -H 'Content-Type: application/json'
 
 from typing import Awaitable
 async def wrap_done(fn: Awaitable, event: asyncio.Event):
-        """Wrap an awaitable with a event to signal when it's done or an exception is raised."""
-        try:
-            await fn
-        except Exception as e:
-            # TODO: handle exception
-            print(f"Caught exception: {e}")
-        finally:
-            # Signal the aiter to stop.
-            event.set()
\ No newline at end of file
+    """Wrap an awaitable with a event to signal when it's done or an exception is raised.
+
+    A failed chain is logged and counted on the current request's timer; the request ends
+    with outcome 'error' and the answer streamed so far.
+    """
+    try:
+        await fn
+        return True
+    except Exception as e:
+        logger.exception("Chain failed")
+        timer = current_timer()
+        if timer is not None:
+            timer.error(e)
+        return False
+    finally:
+        # Signal the aiter to stop.
+        event.set()
\ No newline at end of file